@@ -0,0 +1,173 @@
+"""
+Quran Reels Generator - Background Keyframe Index
+Records keyframe timestamps, duration and fps for each background video so
+segments can start at random keyframe-aligned offsets, which ffmpeg can seek
+to without decoding any preceding frames.
+Imports moviepy, so generator.py loads this module lazily with the media stack.
+"""
+
+import os
+import re
+import json
+import logging
+import subprocess
+import threading
+
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader, ffmpeg_parse_infos
+from moviepy.video.io.VideoFileClip import VideoFileClip
+
+# Bump when the index layout changes so stale sidecars are rebuilt
+INDEX_VERSION = 3
+
+# Prefer offsets that leave at least this much video before the clip has to loop
+MIN_RUN_SECONDS = 10.0
+
+_PTS_TIME = re.compile(r'pts_time:\s*([0-9.]+)')
+
+
+def probe_keyframes(path):
+    """List keyframe timestamps (seconds) by decoding only keyframes with ffmpeg"""
+    cmd = [
+        get_setting("FFMPEG_BINARY"), '-hide_banner', '-nostdin',
+        '-skip_frame', 'nokey', '-i', path,
+        '-an', '-vf', 'showinfo', '-f', 'null', '-'
+    ]
+    popen_params = {"stdout": subprocess.DEVNULL, "stderr": subprocess.PIPE}
+    if os.name == "nt":
+        popen_params["creationflags"] = 0x08000000
+    proc = subprocess.run(cmd, **popen_params)
+    stderr = proc.stderr.decode('utf8', errors='ignore')
+    times = sorted({round(float(t), 6) for t in _PTS_TIME.findall(stderr)})
+    return times or [0.0]
+
+
+class KeyframeSeekReader(FFMPEG_VideoReader):
+    """
+    FFMPEG_VideoReader that seeks with a single input-side -ss.
+    MoviePy's reader seeks one second early and decodes forward, which from a
+    keyframe-aligned offset means decoding back from the previous keyframe.
+    """
+
+    threads = None  # ffmpeg decoder threads (None: ffmpeg's default of one per core)
+
+    def initialize(self, starttime=0):
+        if starttime == 0 and not self.threads:
+            return super().initialize(0)
+
+        self.close()
+        cmd = [get_setting("FFMPEG_BINARY")]
+        if self.threads:
+            cmd += ['-threads', str(self.threads)]
+        if starttime:
+            cmd += ['-ss', "%.06f" % starttime]
+        cmd += ['-i', self.filename,
+                '-loglevel', 'error',
+                '-f', 'image2pipe',
+                '-vf', 'scale=%d:%d' % tuple(self.size),
+                '-sws_flags', self.resize_algo,
+                "-pix_fmt", self.pix_fmt,
+                '-vcodec', 'rawvideo', '-']
+        popen_params = {"bufsize": self.bufsize,
+                        "stdout": subprocess.PIPE,
+                        "stderr": subprocess.PIPE,
+                        "stdin": subprocess.DEVNULL}
+        if os.name == "nt":
+            popen_params["creationflags"] = 0x08000000
+        self.proc = subprocess.Popen(cmd, **popen_params)
+
+
+def open_background(path, start=0.0, size=None, threads=None):
+    """
+    Open a background clip starting at a keyframe offset.
+    size: optional (width, height) for ffmpeg to scale frames to while decoding
+    threads: optional decoder thread limit for the clip's ffmpeg reader
+    Returns: (clip, source) where clip begins at `start` and source is the
+    underlying VideoFileClip that must be closed when done.
+    """
+    source = VideoFileClip(path, audio=False,
+                           target_resolution=(size[1], size[0]) if size else None)
+    # Same reader state, keyframe-exact seeking
+    reader = source.reader
+    reader.__class__ = KeyframeSeekReader
+    reader.threads = threads
+    if threads and not start:
+        # The reader already started ffmpeg without the limit; restart it from the top
+        reader.initialize(0)
+        reader.pos = 1
+        reader.lastread = reader.read_frame()
+    clip = source.subclip(start) if start else source
+    return clip, source
+
+
+class BackgroundIndex:
+    """
+    Per-file keyframe index, built once per background and cached as JSON in
+    cache_dir (the vision folder ships with the bundle and may be read-only).
+    Entries are rebuilt when the background's size or mtime changes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, path):
+        return os.path.join(self.cache_dir, os.path.basename(path) + '.index.json')
+
+    def _load(self, path, st):
+        try:
+            with open(self._cache_path(path), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (entry.get('version') == INDEX_VERSION and entry.get('size') == st.st_size
+                and entry.get('mtime') == int(st.st_mtime)):
+            return entry
+        return None
+
+    def _save(self, path, entry):
+        cache_path = self._cache_path(path)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.warning(f"Could not cache background index for {path}: {e}")
+
+    def build(self, path):
+        """Probe a background and write its index"""
+        st = os.stat(path)
+        infos = ffmpeg_parse_infos(path)
+        entry = {
+            'version': INDEX_VERSION,
+            'size': st.st_size,
+            'mtime': int(st.st_mtime),
+            'duration': infos['video_duration'],
+            'fps': infos['video_fps'],
+            'frame_size': infos['video_size'],
+            'keyframes': probe_keyframes(path)
+        }
+        self._save(path, entry)
+        logging.info(f"Indexed background {os.path.basename(path)}: "
+                     f"{len(entry['keyframes'])} keyframes, {entry['duration']:.1f}s")
+        return entry
+
+    def get(self, path):
+        """Return the index entry for a background, building it on first use"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._load(path, os.stat(path)) or self.build(path)
+                self._entries[path] = entry
+            return entry
+
+    def pick_offset(self, path, rng):
+        """Choose a random keyframe to start from, preferring ones with a long run left"""
+        entry = self.get(path)
+        keyframes = entry['keyframes']
+        run = min(MIN_RUN_SECONDS, entry['duration'] / 2)
+        candidates = [k for k in keyframes if entry['duration'] - k >= run] or keyframes[:1]
+        return rng.choice(candidates)
@@ -36,7 +36,7 @@ version = 1.0.0
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy==2.2.1,requests,pydub,moviepy==1.0.3,pillow,numpy,urllib3,charset-normalizer,certifi,idna,imageio,imageio-ffmpeg,tqdm,proglog,decorator
+requirements = python3,sqlite3,kivy==2.2.1,requests,pydub,moviepy==1.0.3,pillow,numpy,urllib3,charset-normalizer,certifi,idna,imageio,imageio-ffmpeg,tqdm,proglog,decorator
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -0,0 +1,173 @@
+"""
+Quran Reels Generator - CPU Thread Budget
+Shares a fixed number of cores between render processes running jobs at the
+same time. Left alone, every x264 encoder and ffmpeg decoder starts a thread
+per core, so concurrent jobs oversubscribe the machine and finish later in
+total than they would one at a time.
+
+The budget is host-wide: while a job runs, its render process holds a lock on
+its own file in a folder every render process on the machine uses
+(QURAN_REELS_CPU_DIR, default in the temp folder), whether it is a server pool
+worker or a `workers.py --store` process. A job's share is the core count
+divided among the locked files, read again at every stage, so shares grow and
+shrink as other jobs start and finish. A process that dies releases its lock,
+and the next process to read the folder removes its file.
+"""
+
+import os
+import time
+import tempfile
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Cores shared by all render processes on this machine (default: all of them)
+CPU_CORES = int(os.environ.get('QURAN_REELS_CPU_CORES', '0')) or os.cpu_count() or 1
+
+# Folder of lock files shared by every render process on this machine
+CPU_DIR = os.environ.get('QURAN_REELS_CPU_DIR') or os.path.join(tempfile.gettempdir(), 'quran-reels-cpu')
+
+# Part of a job's threads given to its background decoders; the encoder gets the rest
+DECODER_SHARE = 0.25
+
+
+def split_threads(threads):
+    """
+    Split a job's threads between its background decoders and its encoder,
+    which run at the same time. Returns: (decoder_threads, encoder_threads);
+    each gets at least one, so a share of one thread runs two.
+    """
+    decoder = max(1, int(threads * DECODER_SHARE))
+    return decoder, max(1, threads - decoder)
+
+
+def _try_lock(handle):
+    """Lock an open file without waiting; False if another process holds the lock"""
+    try:
+        if os.name == "nt":
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(handle):
+    if os.name == "nt":
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+class CoreBudget:
+    """Core budget shared by every render process on this machine"""
+
+    def __init__(self, cores=None, directory=None):
+        self.cores = cores or CPU_CORES
+        self.directory = directory or CPU_DIR
+
+    def share(self):
+        """A CoreShare to hand to a render process"""
+        return CoreShare(self)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.busy')
+
+    def _claim(self, pid):
+        """Lock this process's file; returns the open handle that holds the lock"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(pid)
+        while True:
+            handle = open(path, 'a+b')
+            # A reader checking whether the file is stale holds the lock briefly,
+            # and may remove the file before we lock it; retry on a fresh one
+            if _try_lock(handle):
+                try:
+                    if os.path.samestat(os.fstat(handle.fileno()), os.stat(path)):
+                        return handle
+                except FileNotFoundError:
+                    pass
+                _unlock(handle)
+            handle.close()
+            time.sleep(0.01)
+
+    def _release(self, handle):
+        _unlock(handle)
+        handle.close()
+        try:
+            os.remove(handle.name)
+        except OSError:
+            pass
+
+    def busy(self):
+        """Pids of the processes on this machine running a job now, in order"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        pids = []
+        for name in names:
+            pid, ext = os.path.splitext(name)
+            if ext != '.busy' or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                handle = open(path, 'rb')
+            except OSError:
+                continue
+            with handle:
+                if not _try_lock(handle):
+                    pids.append(int(pid))
+                    continue
+                # Left behind by a process that died mid-job
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                _unlock(handle)
+        return sorted(pids)
+
+    def _threads(self, busy):
+        # Cores that do not divide evenly go to the lowest pids
+        share, extra = divmod(self.cores, len(busy))
+        return {pid: max(1, share + (1 if i < extra else 0)) for i, pid in enumerate(busy)}
+
+    def allocation(self, pid):
+        """{'threads', 'cores', 'jobs'}: the threads process pid's job may use now"""
+        busy = sorted(set(self.busy()) | {pid})
+        return {'threads': self._threads(busy)[pid], 'cores': self.cores, 'jobs': len(busy)}
+
+    def snapshot(self):
+        """Current allocation of every job running on this machine, keyed by pid"""
+        busy = self.busy()
+        return {
+            'cores': self.cores,
+            'jobs': len(busy),
+            'threads': self._threads(busy) if busy else {}
+        }
+
+
+class CoreShare:
+    """One render process's claim on a CoreBudget (picklable into the process)"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._handle = None
+
+    def begin(self):
+        """Mark this process as running a job"""
+        if self._handle is None:
+            self._handle = self.budget._claim(os.getpid())
+
+    def end(self):
+        if self._handle is not None:
+            self.budget._release(self._handle)
+            self._handle = None
+
+    def allocation(self):
+        return self.budget.allocation(os.getpid())
@@ -5,41 +5,176 @@ Replaces ImageMagick TextClip with Pillow-based text rendering for Android compa
 
 import os
 import sys
+import queue
+import atexit
 import shutil
 import random
 import logging
+import logging.handlers
 import traceback
 import tempfile
 import threading
-import requests
-from io import BytesIO
+import functools
+import json
+import time
+import hashlib
+import sqlite3
+import cProfile
+import pstats
+from io import BytesIO, StringIO
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 
-# Audio processing
-from pydub import AudioSegment
-from pydub.silence import detect_nonsilent
+import upstream
+from memory import MemoryMonitor, MB
+from cpu_budget import split_threads
+from reciter_packs import PackLibrary
+
+# Heavy media modules (requests, pydub, moviepy) are imported on first use by
+# load_media_modules(), so importing this module stays cheap for UI startup.
+requests = None
+AudioSegment = None
+VideoFileClip = ImageClip = CompositeVideoClip = concatenate_videoclips = None
+AudioArrayClip = FFMPEG_VideoWriter = vfx_loop = None
+BackgroundIndex = open_background = None
+
+_media_lock = threading.Lock()
+_media_loaded = False
+
+
+def load_media_modules():
+    """
+    Import the media stack once per process.
+    Imports individual moviepy modules instead of moviepy.editor, which pulls
+    in every effect and preview helper.
+    Returns: seconds spent importing (0.0 if already loaded)
+    """
+    global requests, AudioSegment, VideoFileClip, ImageClip, CompositeVideoClip
+    global concatenate_videoclips, AudioArrayClip, FFMPEG_VideoWriter, vfx_loop, _media_loaded
+    global BackgroundIndex, open_background
+    
+    if _media_loaded:
+        return 0.0
+    with _media_lock:
+        if _media_loaded:
+            return 0.0
+        started = time.perf_counter()
+        
+        import requests as _requests
+        from pydub import AudioSegment as _AudioSegment
+        from moviepy.video.io.VideoFileClip import VideoFileClip as _VideoFileClip
+        from moviepy.video.VideoClip import ImageClip as _ImageClip
+        from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip as _CompositeVideoClip
+        from moviepy.video.compositing.concatenate import concatenate_videoclips as _concatenate_videoclips
+        from moviepy.audio.AudioClip import AudioArrayClip as _AudioArrayClip
+        from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter as _FFMPEG_VideoWriter
+        from moviepy.video.fx.loop import loop as _loop
+        import backgrounds as _backgrounds
+        
+        requests = _requests
+        AudioSegment = _AudioSegment
+        VideoFileClip = _VideoFileClip
+        ImageClip = _ImageClip
+        CompositeVideoClip = _CompositeVideoClip
+        concatenate_videoclips = _concatenate_videoclips
+        AudioArrayClip = _AudioArrayClip
+        FFMPEG_VideoWriter = _FFMPEG_VideoWriter
+        vfx_loop = _loop
+        BackgroundIndex = _backgrounds.BackgroundIndex
+        open_background = _backgrounds.open_background
+        _media_loaded = True
+        
+        elapsed = time.perf_counter() - started
+        logging.info(f"Media modules imported in {elapsed:.2f}s")
+        return elapsed
+
+
+def warm_up_media(callback=None):
+    """Import the media stack in a background thread; callback(seconds) when done"""
+    def run():
+        elapsed = load_media_modules()
+        if callback:
+            callback(elapsed)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
 
-# Video processing
-from moviepy.editor import (
-    VideoFileClip, AudioFileClip, ImageClip, CompositeVideoClip, 
-    concatenate_videoclips, ColorClip
-)
-import moviepy.video.fx.all as vfx
 
 # Configure logging
-def setup_logging(app_dir):
-    log_path = os.path.join(app_dir, "runlog.txt")
-    logging.basicConfig(
-        filename=log_path,
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        force=True
-    )
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    logging.getLogger().addHandler(console_handler)
-    return logging.getLogger()
+# runlog.txt rotation
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+_logging_lock = threading.Lock()
+_logging_configured = False
+_log_listener = None    # QueueListener writing runlog.txt, when this process owns it
+
+
+def setup_logging(app_dir, forward_to=None):
+    """
+    Configure logging once per process; later calls just return the root logger.
+    Log calls only enqueue the record: a QueueListener thread writes it to the
+    console and to runlog.txt, which rotates at LOG_MAX_BYTES.
+    forward_to: a multiprocessing queue from a parent process; records are sent
+    there for the parent to write instead (one writer per runlog.txt). It
+    replaces a configuration that writes runlog.txt itself, e.g. one made while
+    a spawned child re-imported its parent's main module.
+    """
+    global _logging_configured, _log_listener
+    root = logging.getLogger()
+    with _logging_lock:
+        if _logging_configured and (forward_to is None or _log_listener is None):
+            return root
+        
+        if _log_listener is not None:
+            # Flush what was queued, then let go of runlog.txt
+            _log_listener.stop()
+            atexit.unregister(_log_listener.stop)
+            for handler in _log_listener.handlers:
+                handler.close()
+            _log_listener = None
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+        root.setLevel(logging.INFO)
+        
+        if forward_to is not None:
+            root.addHandler(logging.handlers.QueueHandler(forward_to))
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+            file_handler = logging.handlers.RotatingFileHandler(
+                os.path.join(app_dir, "runlog.txt"),
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUP_COUNT,
+                encoding='utf-8'
+            )
+            file_handler.setFormatter(formatter)
+            console_handler = logging.StreamHandler()
+            
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+            listener.start()
+            # Drain queued records on interpreter exit
+            atexit.register(listener.stop)
+            root.addHandler(logging.handlers.QueueHandler(log_queue))
+            _log_listener = listener
+        
+        _logging_configured = True
+    return root
+
+
+def relay_log_records(log_queue):
+    """Write records forwarded by child processes (see setup_logging); runs until None arrives"""
+    while True:
+        try:
+            record = log_queue.get()
+        except (EOFError, OSError):
+            return
+        if record is None:
+            return
+        logging.getLogger(record.name).handle(record)
 
 # Path resolution for Android compatibility
 def get_app_dir():
@@ -86,6 +221,93 @@ SURAH_NAMES = [
     'المسد', 'الإخلاص', 'الفلق', 'الناس'
 ]
 
+# Audio mixing settings for the pre-mixed reel track
+AUDIO_FPS = 44100
+AUDIO_FADE = 0.2
+# Longest silence (seconds) a job may insert between ayahs
+MAX_AYAH_GAP = 10.0
+
+# Loudness normalization applied to every ayah before mixing (part of the job fingerprint)
+LOUDNESS_PROFILE = {
+    'target_lufs': -16.0,     # integrated loudness per ayah (ITU-R BS.1770)
+    'true_peak_db': -1.0,     # ceiling for 4x-oversampled peaks
+    'max_gain_db': 20.0       # never boost near-silent recordings further than this
+}
+
+# Encoder settings for the final MP4 (part of the job fingerprint)
+ENCODER_PROFILE = {
+    'fps': 24,
+    'codec': 'libx264',
+    'audio_fps': AUDIO_FPS,
+    'audio_bitrate': '192k',
+    'ffmpeg_params': ['-movflags', '+faststart']
+}
+
+# Container flags for live jobs: fragmented MP4 with an empty moov up front and
+# a fragment per keyframe (every 2s), so the file plays while it is written.
+# Replaces ENCODER_PROFILE's +faststart, which rewrites the file after encoding.
+LIVE_FFMPEG_PARAMS = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-g', '48']
+
+# Extra output formats a job can fan out to from one composition pass:
+# target aspect ratio, how the composed canvas is fitted ('crop' fills the frame,
+# 'pad' letterboxes it), and optional output height and video bitrate
+# (None keeps the canvas resolution / the encoder's default rate control)
+OUTPUT_FORMATS = {
+    '9:16': {'aspect': (9, 16), 'fit': 'crop', 'height': None, 'bitrate': None},
+    '1:1': {'aspect': (1, 1), 'fit': 'crop', 'height': None, 'bitrate': '2000k'},
+    '16:9': {'aspect': (16, 9), 'fit': 'pad', 'height': 720, 'bitrate': '3000k'},
+}
+
+# How backgrounds are laid out under the ayahs:
+#   per_ayah   - a random background per ayah
+#   continuous - one background decoded sequentially under the whole reel
+# Either way each background starts at a seeded, keyframe-aligned offset.
+BACKGROUND_MODES = ('per_ayah', 'continuous')
+
+# Seconds a cached audio/text asset is trusted before revalidating it upstream
+ASSET_TTL = int(os.environ.get('QURAN_REELS_ASSET_TTL', str(7 * 86400)))
+
+# Ayahs fetched in parallel per job (each host's real concurrency is adaptive, see upstream.py)
+FETCH_WORKERS = 8
+
+# Base URLs ayah MP3s are fetched from, in order of preference, per reciter id
+# ('*' covers reciters without their own list; {reciter_id} is filled in).
+# A mirrors.json of the same shape in the app folder replaces entries.
+AUDIO_MIRRORS = {
+    '*': ['https://everyayah.com/data/{reciter_id}/']
+}
+
+# With several mirrors, a download whose response headers have not arrived within
+# this percentile of the host's recent header latencies is raced against the next mirror
+HEDGE_PERCENTILE = 0.95
+HEDGE_DELAY_DEFAULT = 2.0          # seconds, until a host has enough latency samples
+HEDGE_DELAY_BOUNDS = (0.25, 10.0)
+
+# Pipeline stages in order, as reported to stage_callback
+PIPELINE_STAGES = ('prepare', 'fetch', 'mix', 'compose', 'encode')
+
+# Default end-to-end deadline per job in seconds (0 = none; jobs may set their own).
+# When a stage starts it gets its share of the time left, relative to the
+# stages still to run, so time a stage does not use carries over to later ones.
+JOB_DEADLINE = float(os.environ.get('QURAN_REELS_JOB_DEADLINE', '0'))
+STAGE_BUDGET_SHARES = {'prepare': 0.05, 'fetch': 0.35, 'mix': 0.05, 'compose': 0.15, 'encode': 0.4}
+
+# Per-job memory budget for this process in MB (0 disables the guard; see memory.py).
+# Set QURAN_REELS_TRACE_ALLOCATIONS=1 to also report Python allocation peaks (slower).
+MEMORY_BUDGET_MB = int(os.environ.get('QURAN_REELS_MEMORY_BUDGET_MB', '0'))
+TRACE_ALLOCATIONS = os.environ.get('QURAN_REELS_TRACE_ALLOCATIONS') == '1'
+
+# Degradations applied under a memory budget: the memory one in-flight ayah fetch
+# may need (MP3 + decoded samples), and the budget fraction in use before
+# composition at which a job switches to one continuous background decoder,
+# then to half-resolution frames
+FETCH_MEMORY_MB = 32
+DEGRADE_CONTINUOUS_AT = 0.5
+DEGRADE_RESOLUTION_AT = 0.7
+
+# Bump whenever a code change alters rendered output, so stale videos are not reused
+ENGINE_VERSION = '3'
+
 # Reciters mapping
 RECITERS_MAP = {
     'الشيخ عبدالباسط عبدالصمد': 'AbdulSamad_64kbps_QuranExplorer.Com',
@@ -102,22 +324,929 @@ RECITERS_MAP = {
 }
 
 
+def detect_leading_silence(sound, thresh=-40, chunk=10):
+    """Milliseconds of leading audio quieter than thresh dBFS"""
+    t = 0
+    while t < len(sound) and sound[t:t + chunk].dBFS < thresh:
+        t += chunk
+    return t
+
+
+def find_trim_points(sound, drop_db=16, chunk=10):
+    """
+    Silence to cut from a recitation, relative to its average level.
+    Returns: (leading_ms, trailing_ms)
+    """
+    thresh = sound.dBFS - drop_db
+    return (detect_leading_silence(sound, thresh, chunk),
+            detect_leading_silence(sound.reverse(), thresh, chunk))
+
+
+def audio_to_array(sound, fps=AUDIO_FPS):
+    """Convert a pydub AudioSegment to a float32 stereo array (n, 2) in [-1, 1]"""
+    sound = sound.set_frame_rate(fps).set_channels(2)
+    samples = np.array(sound.get_array_of_samples(), dtype=np.float32)
+    samples /= float(1 << (8 * sound.sample_width - 1))
+    return samples.reshape(-1, 2)
+
+
+def apply_fades(samples, fps=AUDIO_FPS, fade=AUDIO_FADE):
+    """Apply linear fade-in/fade-out in place to a (n, 2) sample array"""
+    n = min(int(round(fade * fps)), len(samples) // 2)
+    if n > 0:
+        ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+        samples[:n] *= ramp
+        samples[-n:] *= ramp[::-1]
+    return samples
+
+
+def k_weighting_response(n, fps=AUDIO_FPS):
+    """
+    Frequency response of the BS.1770 K-weighting filter (shelf + high-pass)
+    at the rfft bins of an n-sample signal.
+    """
+    z1 = np.exp(-1j * np.pi * np.arange(n // 2 + 1) / (n / 2))
+    z2 = z1 * z1
+
+    # Stage 1: high shelf
+    gain_db, f0, q = 3.999843853973347, 1681.974450955533, 0.7071752369554196
+    k = np.tan(np.pi * f0 / fps)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (((vh + vb * k / q + k * k) + 2 * (k * k - vh) * z1 + (vh - vb * k / q + k * k) * z2)
+             / (a0 + 2 * (k * k - 1) * z1 + (1 - k / q + k * k) * z2))
+
+    # Stage 2: high-pass
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = np.tan(np.pi * f0 / fps)
+    a0 = 1 + k / q + k * k
+    highpass = (1 - 2 * z1 + z2) * a0 / (a0 + 2 * (k * k - 1) * z1 + (1 - k / q + k * k) * z2)
+
+    return shelf * highpass
+
+
+# K-weighting is applied as an FIR (the filter's impulse response, which has
+# decayed to nothing well within this many taps) by overlap-add over FFT blocks,
+# so memory stays bounded however long the ayah is
+K_WEIGHTING_TAPS = 8192
+FILTER_FFT_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=4)
+def k_weighting_filter(fps=AUDIO_FPS):
+    """rfft of the K-weighting impulse response, padded to FILTER_FFT_SIZE (complex64)"""
+    taps = np.fft.irfft(k_weighting_response(K_WEIGHTING_TAPS, fps), K_WEIGHTING_TAPS)
+    return np.fft.rfft(taps, FILTER_FFT_SIZE).astype(np.complex64)
+
+
+def k_weighted_hop_power(samples, fps=AUDIO_FPS):
+    """
+    K-weighted power of a (n, 2) signal, summed over both channels and over each
+    complete 100 ms hop. Filtered in float32 blocks of whole hops.
+    Returns: (hop_power: np.ndarray, total_power: float)
+    """
+    hop = int(0.1 * fps)
+    block = max(1, (FILTER_FFT_SIZE - K_WEIGHTING_TAPS + 1) // hop) * hop
+    response = k_weighting_filter(fps)[:, None]
+    hops = []
+    total = 0.0
+    tail = np.zeros((K_WEIGHTING_TAPS - 1, samples.shape[1]), dtype=np.float32)
+    for start in range(0, len(samples), block):
+        chunk = samples[start:start + block]
+        filtered = np.fft.irfft(np.fft.rfft(chunk, FILTER_FFT_SIZE, axis=0) * response,
+                                FILTER_FFT_SIZE, axis=0).astype(np.float32)
+        filtered[:len(tail)] += tail
+        tail = filtered[len(chunk):len(chunk) + K_WEIGHTING_TAPS - 1].copy()
+        power = np.square(filtered[:len(chunk)]).sum(axis=1)
+        total += float(power.sum())
+        complete = len(power) // hop * hop
+        hops.append(power[:complete].reshape(-1, hop).sum(axis=1, dtype=np.float64))
+    return np.concatenate(hops) if hops else np.zeros(0), total
+
+
+def integrated_loudness(samples, fps=AUDIO_FPS):
+    """Gated integrated loudness (LUFS) of an (n, 2) signal, or None if silent"""
+    hop_power, total = k_weighted_hop_power(samples, fps)
+    # 400 ms blocks overlapping by 75%: four consecutive hops each
+    per_block = int(0.4 * fps) // int(0.1 * fps)
+    if len(hop_power) < per_block:
+        energies = np.array([total / len(samples)]) if len(samples) else np.zeros(0)
+    else:
+        cumulative = np.concatenate(([0.0], np.cumsum(hop_power)))
+        energies = (cumulative[per_block:] - cumulative[:-per_block]) / (per_block * int(0.1 * fps))
+
+    with np.errstate(divide='ignore'):
+        loudness = -0.691 + 10 * np.log10(energies)
+    energies = energies[loudness > -70.0]
+    if not len(energies):
+        return None
+    relative_gate = -0.691 + 10 * np.log10(energies.mean()) - 10.0
+    with np.errstate(divide='ignore'):
+        energies = energies[-0.691 + 10 * np.log10(energies) > relative_gate]
+    return -0.691 + 10 * np.log10(energies.mean())
+
+
+# Headroom (3 dB) below which sample peaks are trusted without oversampling
+TRUE_PEAK_MARGIN = 10 ** (3 / 20)
+
+# True peaks are estimated over blocks of this many samples, each padded with
+# TRUE_PEAK_OVERLAP samples of context on both sides that are not measured
+TRUE_PEAK_BLOCK = 1 << 14
+TRUE_PEAK_OVERLAP = 256
+
+
+def sample_peak(samples):
+    """Largest absolute sample value, without an abs() copy of the signal"""
+    return max(float(samples.max()), -float(samples.min())) if len(samples) else 0.0
+
+
+def true_peak(samples, threshold=0.0):
+    """
+    4x-oversampled peak of an (n, 2) signal, oversampling only blocks whose
+    sample peak exceeds `threshold` (the rest cannot reach the ceiling).
+    """
+    peak = sample_peak(samples)
+    n = len(samples)
+    for start in range(0, n, TRUE_PEAK_BLOCK):
+        if sample_peak(samples[start:start + TRUE_PEAK_BLOCK]) <= threshold:
+            continue
+        lo = max(0, start - TRUE_PEAK_OVERLAP)
+        hi = min(n, start + TRUE_PEAK_BLOCK + TRUE_PEAK_OVERLAP)
+        upsampled = np.fft.irfft(np.fft.rfft(samples[lo:hi], axis=0), 4 * (hi - lo), axis=0)
+        # Only the block itself; the padding absorbs the FFT's wrap-around at the edges
+        measured = upsampled[4 * (start - lo):4 * (min(n, start + TRUE_PEAK_BLOCK) - lo)]
+        peak = max(peak, sample_peak(measured) * 4)
+    return peak
+
+
+def normalize_loudness(parts, fps=AUDIO_FPS, profile=LOUDNESS_PROFILE):
+    """
+    Bring every ayah to the same integrated loudness, in place.
+    The K-weighted measurement and the 4x-oversampled true-peak estimate both
+    work through fixed-size float32 blocks, so a long ayah costs no more memory
+    than a short one; the gain is capped so peaks stay under the ceiling.
+    Returns: list of applied gains in dB (0.0 for silent parts)
+    """
+    ceiling = 10 ** (profile['true_peak_db'] / 20)
+    gains = []
+    for part in parts:
+        if len(part) < 2:
+            gains.append(0.0)
+            continue
+        loudness = integrated_loudness(part, fps)
+        if loudness is None:
+            gains.append(0.0)
+            continue
+
+        gain_db = min(profile['target_lufs'] - loudness, profile['max_gain_db'])
+        gain = 10 ** (gain_db / 20)
+        # Inter-sample overs rarely exceed the sample peak by 3 dB, so the
+        # oversampled estimate is only needed when the gain gets close to the ceiling
+        if sample_peak(part) * gain * TRUE_PEAK_MARGIN > ceiling:
+            peak = true_peak(part, threshold=ceiling / (gain * TRUE_PEAK_MARGIN))
+            gain_db = min(gain_db, 20 * np.log10(ceiling / peak))
+        part *= np.float32(10 ** (gain_db / 20))
+        gains.append(float(gain_db))
+    return gains
+
+
+def premix_audio(parts, fps=AUDIO_FPS, fade=AUDIO_FADE, gap=0.0):
+    """
+    Assemble all ayah sample arrays into a single reel buffer.
+    Each part is faded, parts are separated by `gap` seconds of silence, and
+    segment durations are derived from the same sample boundaries so video
+    segments line up exactly with the audio.
+    Returns: (buffer: np.ndarray (n, 2), durations: list of seconds)
+    """
+    if not 0 <= gap <= MAX_AYAH_GAP:
+        raise ValueError(f"Ayah gap must be between 0 and {MAX_AYAH_GAP:g} seconds")
+    gap_len = int(round(gap * fps))
+    lengths = [len(p) + (gap_len if i < len(parts) - 1 else 0) for i, p in enumerate(parts)]
+    bounds = np.concatenate(([0], np.cumsum(lengths)))
+    
+    buffer = np.zeros((int(bounds[-1]), 2), dtype=np.float32)
+    for part, start in zip(parts, bounds[:-1]):
+        buffer[start:start + len(part)] = apply_fades(part.astype(np.float32, copy=True), fps, fade)
+    
+    durations = (np.diff(bounds) / fps).tolist()
+    return buffer, durations
+
+
+def resolve_ayah_range(surah, start_ayah, end_ayah=None):
+    """Clamp a requested range to the surah; the end defaults to start + 9"""
+    max_ayah = VERSE_COUNTS[surah]
+    if end_ayah is None:
+        last_ayah = min(start_ayah + 9, max_ayah)
+    else:
+        last_ayah = min(end_ayah, max_ayah)
+    return max(last_ayah, start_ayah)
+
+
+def job_seed(reciter_id, surah, start_ayah, last_ayah, seed=None):
+    """Seed for background choice; derived from the inputs when not given"""
+    if seed is not None:
+        return int(seed)
+    key = f'{reciter_id}:{surah}:{start_ayah}:{last_ayah}'.encode('utf-8')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+
+def job_fingerprint(parts):
+    """Canonical SHA-256 of everything that determines a rendered video"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def live_output_path(out_dir, live_id):
+    """Where a live job's fragmented MP4 is written while it encodes"""
+    return os.path.join(out_dir, 'live', f'{live_id}.mp4')
+
+
+def publish_live_output(live_path, output_path):
+    """
+    Move a finished live file to output_path.
+    On Windows a reader still streaming the live file blocks the rename; the
+    file is then copied instead and left for remove_live_output.
+    Returns: True if the live file was moved
+    """
+    try:
+        os.replace(live_path, output_path)
+        return True
+    except OSError:
+        shutil.copyfile(live_path, output_path)
+        return False
+
+
+def remove_live_output(live_path):
+    """Delete a live file left behind by publish_live_output, if no reader holds it open"""
+    try:
+        os.unlink(live_path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+
+
+def scaled_size(size, scale):
+    """(width, height) scaled and rounded down to even numbers, as libx264 requires"""
+    return tuple(max(2, int(side * scale) // 2 * 2) for side in size)
+
+
+def scale_image_file(path, scale):
+    """Resize an image file in place"""
+    with Image.open(path) as img:
+        img.load()
+    img.resize(scaled_size(img.size, scale), Image.LANCZOS).save(path)
+
+
+def profile_path_for(output_path):
+    """Where a profiled job's cProfile stats are saved: next to its video"""
+    return os.path.splitext(output_path)[0] + '.prof'
+
+
+def profile_summary(path, limit=40):
+    """Top functions by cumulative time from a saved profile, as text"""
+    out = StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+class OutputIndex:
+    """
+    Maps job fingerprints to rendered videos so a repeat request can return
+    the existing file. Stored as JSON next to the videos; entries whose file
+    has since been deleted are treated as misses.
+    """
+    
+    FILENAME = '.index.json'
+    
+    def __init__(self, video_dir):
+        self.video_dir = video_dir
+        self.path = os.path.join(video_dir, self.FILENAME)
+        self._lock = threading.Lock()
+    
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def lookup(self, fingerprint):
+        """Return the path of an already rendered video, or None"""
+        name = self._read().get(fingerprint)
+        if name:
+            path = os.path.join(self.video_dir, name)
+            if os.path.isfile(path):
+                return path
+        return None
+    
+    def record(self, fingerprint, output_path):
+        """Remember the video rendered for a fingerprint"""
+        with self._lock:
+            entries = self._read()
+            entries[fingerprint] = os.path.basename(output_path)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+
+class AudioIndex:
+    """
+    SQLite index of per-ayah audio analysis: silence trim points, trimmed
+    duration and peak/RMS levels per (reciter, surah, ayah). Rows are keyed
+    on the sha256 of the downloaded file, so a changed recording is re-analysed
+    even when it has the same size.
+    """
+    
+    FILENAME = 'audio_index.sqlite'
+    
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.FILENAME)
+        conn = self._connect()
+        try:
+            with conn:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(ayah_audio)')]
+                if columns and 'digest' not in columns:
+                    # Rows keyed on file size cannot be trusted; analysis is cheap to redo
+                    conn.execute('DROP TABLE ayah_audio')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS ayah_audio ('
+                    ' reciter TEXT NOT NULL, surah INTEGER NOT NULL, ayah INTEGER NOT NULL,'
+                    ' digest TEXT NOT NULL, trim_start INTEGER NOT NULL, trim_end INTEGER NOT NULL,'
+                    ' duration INTEGER NOT NULL, peak_db REAL, rms_db REAL,'
+                    ' PRIMARY KEY (reciter, surah, ayah))'
+                )
+        finally:
+            conn.close()
+    
+    def _connect(self):
+        # Worker processes share the file; WAL lets readers proceed during writes
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+    
+    @staticmethod
+    def digest(content):
+        """Key of a downloaded recording's bytes"""
+        return hashlib.sha256(content).hexdigest()
+    
+    def lookup(self, reciter_id, surah, ayah, digest):
+        """Return the stored analysis as a dict, or None if missing or stale"""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                'SELECT trim_start, trim_end, duration, peak_db, rms_db FROM ayah_audio'
+                ' WHERE reciter = ? AND surah = ? AND ayah = ? AND digest = ?',
+                (reciter_id, surah, ayah, digest)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return dict(zip(('trim_start', 'trim_end', 'duration', 'peak_db', 'rms_db'), row))
+    
+    def record(self, reciter_id, surah, ayah, digest, trim_start, trim_end, duration,
+               peak_db=None, rms_db=None):
+        """Store the analysis of one downloaded ayah"""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO ayah_audio VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (reciter_id, surah, ayah, digest, trim_start, trim_end, duration, peak_db, rms_db)
+                )
+        finally:
+            conn.close()
+
+
+class AssetCache:
+    """
+    Local cache of upstream files (ayah MP3s and texts) keyed by URL.
+    Entries younger than `ttl` seconds are served without touching the network;
+    older ones are revalidated with If-None-Match / If-Modified-Since, so an
+    unchanged asset costs a 304 instead of a full transfer. If revalidation
+    fails, the stale copy is served.
+    """
+    
+    FILENAME = 'assets.sqlite'
+    
+    def __init__(self, cache_dir, ttl=None):
+        self.ttl = ASSET_TTL if ttl is None else ttl
+        self.files_dir = os.path.join(cache_dir, 'assets')
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.FILENAME)
+        conn = self._connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS assets ('
+                ' url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,'
+                ' size INTEGER NOT NULL, checked REAL NOT NULL)'
+            )
+        finally:
+            conn.close()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+    
+    def _file(self, url):
+        return os.path.join(self.files_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+    
+    def _read(self, url, size):
+        try:
+            with open(self._file(url), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        return content if len(content) == size else None
+    
+    def _store(self, url, content, etag, last_modified):
+        path = self._file(url)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?)',
+                         (url, etag, last_modified, len(content), time.time()))
+        finally:
+            conn.close()
+    
+    def _touch(self, url):
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE assets SET checked = ? WHERE url = ?', (time.time(), url))
+        finally:
+            conn.close()
+    
+    def get(self, url, timeout=30, cancel=None, fetch=None):
+        """
+        Return the asset's bytes, from the cache when fresh or still valid upstream.
+        fetch: optional Function() -> (status, headers, body) used instead of a plain
+        GET of url on a cache miss (e.g. a hedged request across mirrors).
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT etag, last_modified, size, checked FROM assets WHERE url = ?',
+                               (url,)).fetchone()
+        finally:
+            conn.close()
+        
+        cached = self._read(url, row[2]) if row else None
+        if cached is None:
+            status, headers, content = fetch() if fetch else http_request(url, timeout, cancel)
+            self._store(url, content, headers.get('ETag'), headers.get('Last-Modified'))
+            return content
+        
+        etag, last_modified, _, checked = row
+        if time.time() - checked < self.ttl:
+            return cached
+        
+        conditional = {}
+        if etag:
+            conditional['If-None-Match'] = etag
+        if last_modified:
+            conditional['If-Modified-Since'] = last_modified
+        try:
+            status, headers, content = http_request(url, timeout, cancel, headers=conditional)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            logging.warning(f"Revalidating {url} failed ({e}); using cached copy")
+            return cached
+        
+        if status == 304:
+            self._touch(url)
+            return cached
+        logging.info(f"Upstream asset changed: {url}")
+        self._store(url, content, headers.get('ETag'), headers.get('Last-Modified'))
+        return content
+
+
+class GenerationCancelled(Exception):
+    """Raised inside the pipeline when the user cancels a generation"""
+
+
+class StageTimeout(Exception):
+    """Raised inside the pipeline when a stage runs past its share of the job deadline"""
+
+    def __init__(self, stage, budget, deadline):
+        super().__init__(f"Deadline exceeded during {stage} "
+                         f"(stage budget {budget:.1f}s of a {deadline:g}s job deadline)")
+        self.stage = stage
+
+
+class JobDeadline:
+    """
+    Splits a job's deadline into stage budgets. begin(stage) arms a timer for
+    the stage's budget that aborts the job through its CancelToken, and sets
+    the token's deadline so network timeouts never outlast the budget.
+    """
+    
+    def __init__(self, seconds, cancel, shares=None):
+        self.seconds = seconds
+        self.cancel = cancel
+        self.shares = shares or STAGE_BUDGET_SHARES
+        self.expires = time.monotonic() + seconds
+        self._timer = None
+    
+    def begin(self, stage):
+        """Start the budget of `stage` (a PIPELINE_STAGES name); returns it in seconds"""
+        self.stop()
+        left = max(0.0, self.expires - time.monotonic())
+        later = PIPELINE_STAGES[PIPELINE_STAGES.index(stage):]
+        budget = left * self.shares[stage] / sum(self.shares[name] for name in later)
+        self.cancel.deadline = time.monotonic() + budget
+        self._timer = threading.Timer(budget, self.cancel.abort, args=(StageTimeout(stage, budget, self.seconds),))
+        self._timer.daemon = True
+        self._timer.start()
+        return budget
+    
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.cancel.deadline = None
+
+
+class CancelToken:
+    """
+    Cooperative cancellation shared by downloads, composition and encoding.
+    Blocking resources (HTTP responses, ffmpeg processes) are registered with
+    track() so cancel() can close or kill them instead of waiting on them.
+    """
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._resources = []
+        self._error = None
+        self.deadline = None   # time.monotonic() the current stage must finish by (see JobDeadline)
+    
+    @property
+    def cancelled(self):
+        """True if the user cancelled (not if the job was aborted with an error)"""
+        return self._event.is_set() and self._error is None
+    
+    def cancel(self):
+        """Request cancellation and abort every tracked resource"""
+        self._event.set()
+        with self._lock:
+            resources = list(self._resources)
+        for resource in resources:
+            self._abort(resource)
+    
+    def abort(self, error):
+        """Stop the job like cancel(), but make check() raise `error` so it fails with it"""
+        if not self._event.is_set():
+            self._error = error
+        self.cancel()
+    
+    def remaining(self, limit=None):
+        """Seconds until the current deadline, capped at `limit` (limit when there is none)"""
+        if self.deadline is None:
+            return limit
+        left = max(0.05, self.deadline - time.monotonic())
+        return left if limit is None else min(limit, left)
+    
+    def check(self):
+        """Raise GenerationCancelled (or the abort error) if the job was stopped"""
+        if self._event.is_set():
+            raise self._error or GenerationCancelled("Cancelled by user")
+    
+    def sleep(self, seconds):
+        """Wait up to `seconds`, raising as check() does as soon as the job is stopped"""
+        if self._event.wait(seconds):
+            self.check()
+    
+    @contextmanager
+    def track(self, resource):
+        """Register a response/process so cancel() can abort it while in use"""
+        with self._lock:
+            self._resources.append(resource)
+        try:
+            if self._event.is_set():
+                self._abort(resource)
+            yield resource
+        finally:
+            with self._lock:
+                self._resources.remove(resource)
+    
+    @staticmethod
+    def _abort(resource):
+        try:
+            if hasattr(resource, 'kill'):
+                resource.kill()
+            else:
+                resource.close()
+        except Exception:
+            pass
+
+
+def http_get(url, timeout=30, cancel=None, chunk_size=64 * 1024, retries=2):
+    """Download a URL into memory (see http_request)"""
+    return http_request(url, timeout, cancel, chunk_size, retries)[2]
+
+
+def http_request(url, timeout=30, cancel=None, chunk_size=64 * 1024, retries=2, headers=None,
+                 on_response=None):
+    """
+    Download a URL into memory in chunks so a cancel interrupts the transfer.
+    Requests wait for a slot under the host's adaptive concurrency limit (see
+    upstream.py), which samples latency at the response headers rather than at
+    the end of the body; throttling responses (429/5xx) and timeouts are retried with backoff.
+    on_response: optional Function() called when the response headers arrive
+    Returns: (status_code, response headers, body); 304 responses have an empty body
+    """
+    load_media_modules()
+    cancel = cancel or CancelToken()
+    limiter = upstream.limiter_for(url)
+    
+    for attempt in range(retries + 1):
+        cancel.check()
+        started = limiter.acquire(cancel)
+        ok = throttled = False
+        retry_after = latency = None
+        try:
+            r = requests.get(url, timeout=cancel.remaining(timeout), stream=True, headers=headers)
+            latency = time.monotonic() - started
+            if on_response is not None:
+                on_response()
+            with cancel.track(r):
+                try:
+                    if r.status_code == 429 or r.status_code >= 500:
+                        throttled = True
+                        retry_after = r.headers.get('Retry-After')
+                    r.raise_for_status()
+                    chunks = []
+                    for chunk in r.iter_content(chunk_size):
+                        cancel.check()
+                        chunks.append(chunk)
+                    ok = True
+                    return r.status_code, r.headers, b''.join(chunks)
+                except GenerationCancelled:
+                    raise
+                except Exception:
+                    # A cancel closes the response under us; report that rather than the I/O error
+                    cancel.check()
+                    raise
+                finally:
+                    r.close()
+        except (requests.Timeout, requests.ConnectionError):
+            cancel.check()
+            throttled = True
+            if attempt == retries:
+                raise
+        except requests.HTTPError:
+            if not throttled or attempt == retries:
+                raise
+        finally:
+            limiter.release(started, ok, throttled, latency)
+        
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt
+        logging.warning(f"Upstream throttled {url}; retrying in {min(delay, 10):.1f}s")
+        cancel.sleep(min(delay, 10))
+
+
+def hedge_delay(url):
+    """Seconds to wait on a request to url before racing another mirror"""
+    delay = upstream.limiter_for(url).latency_percentile(HEDGE_PERCENTILE)
+    low, high = HEDGE_DELAY_BOUNDS
+    return HEDGE_DELAY_DEFAULT if delay is None else min(high, max(low, delay))
+
+
+def hedged_request(urls, timeout=30, cancel=None, validate=None):
+    """
+    GET one resource from ordered mirror URLs. The next mirror is started when
+    none of the requests in flight has received response headers within
+    hedge_delay(), or right away when one fails; the first complete response
+    that passes validate(body) wins and the others are aborted.
+    Returns: (url, status, headers, body) of the winning response
+    """
+    cancel = cancel or CancelToken()
+    results = queue.Queue()
+    answered = threading.Event()
+    tokens = []
+    errors = []
+    
+    def attempt(url, token):
+        try:
+            status, headers, body = http_request(url, timeout, token, retries=0,
+                                                 on_response=answered.set)
+            if validate is not None and not validate(body):
+                raise ValueError(f"Invalid response body ({len(body)} bytes)")
+            results.put((url, (status, headers, body), None))
+        except BaseException as e:
+            results.put((url, None, e))
+    
+    def launch(index):
+        token = CancelToken()
+        token.deadline = cancel.deadline
+        tokens.append(token)
+        threading.Thread(target=attempt, args=(urls[index], token), daemon=True).start()
+        return time.monotonic() + hedge_delay(urls[index])
+    
+    deadline = launch(0)
+    launched = pending = 1
+    try:
+        while True:
+            cancel.check()
+            try:
+                url, response, error = results.get(timeout=0.1)
+            except queue.Empty:
+                # Hedge delays are header latencies; a body that is already
+                # arriving is not raced, however long it takes to finish
+                if launched < len(urls) and not answered.is_set() and time.monotonic() >= deadline:
+                    for slow in urls[:launched]:
+                        upstream.limiter_for(slow).record_hedge()
+                    logging.info(f"Hedging slow download to mirror {urls[launched]}")
+                    deadline = launch(launched)
+                    launched += 1
+                    pending += 1
+                continue
+            
+            pending -= 1
+            if error is None:
+                if launched > 1:
+                    upstream.limiter_for(url).record_hedge(won=True)
+                return (url,) + response
+            errors.append(f"{url}: {error}")
+            if pending == 0:
+                answered.clear()
+            if launched < len(urls):
+                deadline = launch(launched)
+                launched += 1
+                pending += 1
+            elif pending == 0:
+                if len(urls) == 1:
+                    raise error
+                raise IOError("All mirrors failed: " + '; '.join(errors))
+    finally:
+        for token in tokens:
+            token.cancel()
+
+
+def looks_like_mp3(content):
+    """Cheap check that a download is an MP3 (ID3 tag or MPEG frame sync), not an error page"""
+    return len(content) > 128 and (content[:3] == b'ID3' or (content[0] == 0xFF and content[1] & 0xE0 == 0xE0))
+
+
+def load_audio_mirrors(app_dir):
+    """AUDIO_MIRRORS updated with mirrors.json from the app folder, if present"""
+    mirrors = dict(AUDIO_MIRRORS)
+    path = os.path.join(app_dir, 'mirrors.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            mirrors.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring invalid mirror list {path}: {e}")
+    return mirrors
+
+
+def output_variants(output_path, formats):
+    """
+    File paths for a multi-format render: the first format is written to
+    output_path itself, the others next to it with the format as a suffix.
+    """
+    stem, ext = os.path.splitext(output_path)
+    return {
+        fmt: output_path if i == 0 else f"{stem}_{fmt.replace(':', 'x')}{ext}"
+        for i, fmt in enumerate(formats)
+    }
+
+
+def format_filter(canvas_size, fmt):
+    """ffmpeg video filter fitting a composed canvas of canvas_size to an OUTPUT_FORMATS entry"""
+    spec = OUTPUT_FORMATS[fmt]
+    width, height = canvas_size
+    aspect_w, aspect_h = spec['aspect']
+    even = lambda x: max(2, int(round(x)) // 2 * 2)
+    
+    fitted_height = width * aspect_h / aspect_w
+    if spec['fit'] == 'crop':
+        # Largest centered region of the target aspect inside the canvas
+        if fitted_height <= height:
+            vf = f'crop={even(width)}:{even(fitted_height)}'
+        else:
+            vf = f'crop={even(height * aspect_w / aspect_h)}:{even(height)}'
+    else:
+        # Smallest frame of the target aspect around the canvas, canvas centered
+        if fitted_height >= height:
+            size = f'{even(width)}:{even(fitted_height)}'
+        else:
+            size = f'{even(height * aspect_w / aspect_h)}:{even(height)}'
+        vf = f'pad={size}:(ow-iw)/2:(oh-ih)/2:black'
+    if spec['height']:
+        vf += f",scale=-2:{spec['height']}"
+    return vf
+
+
+def write_video(clip, output_path, fps=24, audio_fps=AUDIO_FPS, audio_bitrate='192k',
+                ffmpeg_params=None, cancel=None, progress_callback=None, variants=None,
+                threads=None):
+    """
+    Encode a clip to MP4 (libx264/aac).
+    Same output as clip.write_videofile, but the ffmpeg encoder process is owned
+    here so a cancel kills it immediately, and partial files are removed on failure.
+    progress_callback: Function(fraction) called about every 1% of encoded frames.
+    variants: optional list of (path, video_filter, bitrate) encoded together
+    instead of output_path alone; each frame is composed once and piped to every
+    encoder, and the AAC track is encoded once and copied into each file.
+    threads: optional encoder thread limit, split between the variants' encoders.
+    """
+    load_media_modules()
+    cancel = cancel or CancelToken()
+    outputs = variants or [(output_path, None, None)]
+    temp_audio = os.path.splitext(output_path)[0] + '_temp_audio.m4a'
+    audiofile = None
+    success = False
+    writers = []
+    
+    try:
+        if clip.audio is not None:
+            clip.audio.write_audiofile(temp_audio, fps=audio_fps, codec='aac',
+                                       bitrate=audio_bitrate, logger=None)
+            audiofile = temp_audio
+        cancel.check()
+        
+        nframes = max(1, int(clip.duration * fps))
+        step = max(1, nframes // 100)
+        with ExitStack() as tracked:
+            try:
+                for path, video_filter, bitrate in outputs:
+                    params = list(ffmpeg_params or [])
+                    if video_filter:
+                        params += ['-vf', video_filter]
+                    if threads:
+                        params += ['-threads', str(max(1, threads // len(outputs)))]
+                    writer = FFMPEG_VideoWriter(path, clip.size, fps, codec='libx264', bitrate=bitrate,
+                                                audiofile=audiofile, ffmpeg_params=params)
+                    writers.append(writer)
+                    tracked.enter_context(cancel.track(writer.proc))
+                
+                for i, frame in enumerate(clip.iter_frames(fps=fps, dtype='uint8')):
+                    cancel.check()
+                    for writer in writers:
+                        writer.write_frame(frame)
+                    if progress_callback and (i + 1) % step == 0:
+                        progress_callback(min(1.0, (i + 1) / nframes))
+            except BaseException:
+                # Stop the encoders right away instead of letting them flush buffered frames
+                for writer in writers:
+                    writer.proc.kill()
+                    writer.proc.wait()
+                cancel.check()
+                raise
+            finally:
+                for writer in writers:
+                    try:
+                        writer.close()
+                    except OSError:
+                        pass
+        success = True
+    finally:
+        if os.path.exists(temp_audio):
+            os.unlink(temp_audio)
+        if not success:
+            for path, _, _ in outputs:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
 class VideoGenerator:
     """Android-compatible video generator using Pillow instead of ImageMagick"""
     
-    def __init__(self, app_dir=None, bundle_dir=None, progress_callback=None, log_callback=None):
+    def __init__(self, app_dir=None, bundle_dir=None, progress_callback=None, log_callback=None,
+                 stage_callback=None, memory_budget_mb=None, cpu_share=None):
         self.app_dir = app_dir or get_app_dir()
         self.bundle_dir = bundle_dir or get_bundle_dir()
         self.logger = setup_logging(self.app_dir)
         
         self.progress_callback = progress_callback or (lambda p, s: None)
         self.log_callback = log_callback or (lambda m: None)
+        self.stage_callback = stage_callback or (lambda name, seconds: None)
+        self.memory_budget_mb = MEMORY_BUDGET_MB if memory_budget_mb is None else memory_budget_mb
+        self.memory = None
+        self.job_deadline = None
+        self.profile_path = None    # stats saved by the last profiled job
+        # Optional cpu_budget.CoreShare; without one ffmpeg uses every core
+        self.cpu_share = cpu_share
         
         # Setup directories
         self.out_dir = os.path.join(self.app_dir, "outputs")
         self.audio_dir = os.path.join(self.out_dir, "audio")
         self.video_dir = os.path.join(self.out_dir, "video")
         self.font_dir = os.path.join(self.app_dir, "fonts")
+        self.cache_dir = os.path.join(self.out_dir, "cache")
+        self.packs_dir = os.path.join(self.app_dir, "packs")
         self.vision_dir = os.path.join(self.bundle_dir, "vision")
         
         # Font paths
@@ -132,6 +1261,34 @@ class VideoGenerator:
         
         self.is_running = False
         self.should_stop = False
+        self.cancel_token = CancelToken()
+        
+        self.output_index = OutputIndex(self.video_dir)
+        self.packs = PackLibrary(self.packs_dir)
+        self.audio_mirrors = load_audio_mirrors(self.app_dir)
+        self.audio_index = AudioIndex(self.cache_dir)
+        self.assets = AssetCache(self.cache_dir)
+        
+        # Caches kept warm for long-lived generators (see preload)
+        self._fonts = {}
+        self._backgrounds = None
+        self._background_index = None
+        
+    def preload(self):
+        """
+        Load everything a generation needs up front: media modules, the Arabic
+        font at every size render_text_to_image uses, and the background list
+        with each background's keyframe index.
+        Returns: seconds spent
+        """
+        started = time.perf_counter()
+        load_media_modules()
+        for fontsize in (16, 20, 25, 30, 35):
+            self.get_font(fontsize)
+        index = self.get_background_index()
+        for name in self.list_backgrounds():
+            index.get(os.path.join(self.vision_dir, name))
+        return time.perf_counter() - started
         
     def update_progress(self, percent, status):
         """Update progress with callback"""
@@ -142,49 +1299,105 @@ class VideoGenerator:
         self.log_callback(message)
         self.logger.info(message)
         
+    def end_stage(self, name, started):
+        """Report a pipeline stage's duration; returns the start time of the next stage"""
+        now = time.perf_counter()
+        self.stage_callback(name, now - started)
+        position = PIPELINE_STAGES.index(name)
+        following = PIPELINE_STAGES[position + 1] if position + 1 < len(PIPELINE_STAGES) else None
+        if self.job_deadline is not None and following:
+            budget = self.job_deadline.begin(following)
+            self.add_log(f'[deadline] {following}: {budget:.1f}s budget')
+        if self.memory is not None:
+            peak = self.memory.end_stage(name, following)
+            python = f", Python {peak['python_mb']} MB" if 'python_mb' in peak else ''
+            self.add_log(f"[mem] {name}: peak RSS {peak['rss_mb']} MB{python}")
+        return now
+        
+    def cpu_threads(self, stage):
+        """Threads this job may use for `stage` under the shared core budget, or None"""
+        if self.cpu_share is None:
+            return None
+        allocation = self.cpu_share.allocation()
+        self.add_log(f"[cpu] {stage}: {allocation['threads']} of {allocation['cores']} cores "
+                     f"({allocation['jobs']} job(s) running)")
+        return allocation['threads']
+        
     def detect_leading_silence(self, sound, thresh=-40, chunk=10):
         """Detect leading silence in audio"""
-        t = 0
-        while t < len(sound) and sound[t:t + chunk].dBFS < thresh:
-            t += chunk
-        return t
+        return detect_leading_silence(sound, thresh, chunk)
 
     def detect_trailing_silence(self, sound, thresh=-40, chunk=10):
         """Detect trailing silence in audio"""
-        return self.detect_leading_silence(sound.reverse(), thresh, chunk)
+        return detect_leading_silence(sound.reverse(), thresh, chunk)
 
     def download_audio(self, reciter_id, surah, ayah, idx):
-        """Download and trim audio for a specific verse"""
+        """Download and trim audio for a specific verse (from the reciter's pack when installed)"""
+        load_media_modules()
         os.makedirs(self.audio_dir, exist_ok=True)
         fn = f'{surah:03d}{ayah:03d}.mp3'
-        url = f'https://everyayah.com/data/{reciter_id}/{fn}'
+        mirrors = self.audio_mirrors.get(reciter_id) or self.audio_mirrors['*']
+        urls = [base.format(reciter_id=reciter_id) + fn for base in mirrors]
+        url = urls[0]
         out = os.path.join(self.audio_dir, f'part{idx}.mp3')
         
-        self.logger.info(f"Downloading audio from: {url}")
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
+        pack = self.packs.get(reciter_id)
+        entry = pack.entry(surah, ayah) if pack else None
+        if entry is not None:
+            # Trim points were computed when the pack was built
+            snd = AudioSegment.from_file(BytesIO(pack.read(surah, ayah)), 'mp3')
+            snd[entry.trim_start:len(snd) - entry.trim_end].export(out, format='mp3')
+            return out
+        
+        def fetch_from_mirrors():
+            source, status, headers, body = hedged_request(urls, timeout=30, cancel=self.cancel_token,
+                                                           validate=looks_like_mp3)
+            if source != url:
+                self.add_log(f'[3] Verse {ayah} served by mirror {source}')
+                # Validators from another mirror mean nothing to the primary
+                headers = {}
+            return status, headers, body
+        
+        self.logger.info(f"Fetching audio from: {url}")
+        # The cache is keyed by the primary URL whichever mirror answers
+        content = self.assets.get(url, timeout=30, cancel=self.cancel_token,
+                                  fetch=fetch_from_mirrors if len(urls) > 1 else None)
         
         with open(out, 'wb') as f:
-            f.write(r.content)
+            f.write(content)
         
-        # Trim silence
+        # Trim silence, reusing trim points found for this recitation before
         snd = AudioSegment.from_file(out, 'mp3')
-        thresh = snd.dBFS - 16
-        start = self.detect_leading_silence(snd, thresh)
-        end = self.detect_trailing_silence(snd, thresh)
+        digest = AudioIndex.digest(content)
+        known = self.audio_index.lookup(reciter_id, surah, ayah, digest)
+        if known:
+            start, end = known['trim_start'], known['trim_end']
+        else:
+            start, end = find_trim_points(snd)
         trimmed = snd[start:len(snd) - end]
         trimmed.export(out, format='mp3')
         
+        if not known:
+            peak_db = trimmed.max_dBFS if len(trimmed) else None
+            rms_db = trimmed.dBFS if len(trimmed) else None
+            self.audio_index.record(reciter_id, surah, ayah, digest, start, end, len(trimmed),
+                                    None if peak_db == float('-inf') else peak_db,
+                                    None if rms_db == float('-inf') else rms_db)
+        
         return out
 
+    def load_audio_samples(self, audio_path):
+        """Decode a trimmed ayah MP3 into a float32 sample array for premixing"""
+        return audio_to_array(AudioSegment.from_file(audio_path, 'mp3'))
+
     def get_ayah_text(self, surah, ayah):
         """Fetch Arabic text for a verse"""
-        resp = requests.get(
+        content = self.assets.get(
             f'https://api.alquran.cloud/v1/ayah/{surah}:{ayah}/quran-uthmani',
-            timeout=10
+            timeout=10,
+            cancel=self.cancel_token
         )
-        resp.raise_for_status()
-        return resp.json()['data']['text']
+        return json.loads(content)['data']['text']
 
     def wrap_text(self, text, per_line):
         """Wrap text into multiple lines"""
@@ -219,22 +1432,16 @@ class VideoGenerator:
         
         wrapped_text = self.wrap_text(text, per_line)
         
-        # Load font
-        try:
-            font = ImageFont.truetype(self.font_path_arabic, fontsize)
-        except Exception as e:
-            self.logger.error(f"Failed to load font: {e}")
-            # Fallback to default
-            font = ImageFont.load_default()
+        font = self.get_font(fontsize)
         
         # Calculate text size
         dummy_img = Image.new('RGBA', (1, 1), (0, 0, 0, 0))
         dummy_draw = ImageDraw.Draw(dummy_img)
         
         # Get text bounding box
-        bbox = dummy_draw.multilinebbox((0, 0), wrapped_text, font=font, align='center')
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+        bbox = dummy_draw.multiline_textbbox((0, 0), wrapped_text, font=font, align='center')
+        text_width = int(bbox[2] - bbox[0])
+        text_height = int(bbox[3] - bbox[1])
         
         # Add padding
         padding = 40
@@ -264,32 +1471,154 @@ class VideoGenerator:
         
         return temp_file.name, fontsize
 
-    def pick_background(self):
-        """Select random background video"""
+    def get_font(self, fontsize):
+        """Load the Arabic font at a size, cached per generator"""
+        font = self._fonts.get(fontsize)
+        if font is None:
+            try:
+                font = ImageFont.truetype(self.font_path_arabic, fontsize)
+            except Exception as e:
+                self.logger.error(f"Failed to load font: {e}")
+                # Fallback to default
+                font = ImageFont.load_default()
+            self._fonts[fontsize] = font
+        return font
+
+    def list_backgrounds(self):
+        """List background videos in the vision folder (cached after the first call)"""
+        if self._backgrounds is None:
+            self._backgrounds = sorted(
+                f for f in os.listdir(self.vision_dir)
+                if f.startswith('nature_part') and f.endswith('.mp4')
+            )
+        return self._backgrounds
+
+    def pick_background(self, rng=None):
+        """Select random background video (from rng when given, for repeatable picks)"""
         try:
-            files = [f for f in os.listdir(self.vision_dir) 
-                    if f.startswith('nature_part') and f.endswith('.mp4')]
+            files = self.list_backgrounds()
             if not files:
                 raise ValueError("No background videos found in vision folder")
-            return os.path.join(self.vision_dir, random.choice(files))
+            return os.path.join(self.vision_dir, (rng or random).choice(files))
         except Exception as e:
             self.logger.error(f"Error picking background: {e}")
             raise
 
+    def get_background_index(self):
+        """Keyframe index for the backgrounds (cached in outputs/cache)"""
+        if self._background_index is None:
+            load_media_modules()
+            self._background_index = BackgroundIndex(self.cache_dir)
+        return self._background_index
+
+    def plan_job(self, reciter_id, surah, start_ayah, end_ayah=None, ayah_gap=0.0, seed=None,
+                 background_mode='per_ayah', formats=None):
+        """
+        Resolve everything that determines the output before rendering:
+        the ayah range, the seeded background picks and start offsets, and the
+        job fingerprint.
+        """
+        if background_mode not in BACKGROUND_MODES:
+            raise ValueError(f"Unknown background mode: {background_mode}")
+        for fmt in formats or []:
+            if fmt not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown output format: {fmt}")
+        if not 0 <= float(ayah_gap) <= MAX_AYAH_GAP:
+            raise ValueError(f"Ayah gap must be between 0 and {MAX_AYAH_GAP:g} seconds")
+        
+        last_ayah = resolve_ayah_range(surah, start_ayah, end_ayah)
+        seed = job_seed(reciter_id, surah, start_ayah, last_ayah, seed)
+        rng = random.Random(seed)
+        count = 1 if background_mode == 'continuous' else last_ayah - start_ayah + 1
+        backgrounds = [self.pick_background(rng) for _ in range(count)]
+        index = self.get_background_index()
+        offsets = [index.pick_offset(bg, rng) for bg in backgrounds]
+        
+        parts = {
+            'reciter': reciter_id,
+            'surah': surah,
+            'ayahs': [start_ayah, last_ayah],
+            'ayah_gap': float(ayah_gap),
+            'seed': seed,
+            'background_mode': background_mode,
+            'backgrounds': [os.path.basename(bg) for bg in backgrounds],
+            'offsets': offsets,
+            'style': {'font': os.path.basename(self.font_path_arabic), 'text_width': 900},
+            'loudness': LOUDNESS_PROFILE,
+            'encoder': ENCODER_PROFILE,
+            'version': ENGINE_VERSION
+        }
+        if formats:
+            # Single-format jobs keep their existing fingerprints
+            parts['formats'] = [[fmt, OUTPUT_FORMATS[fmt]] for fmt in formats]
+        fingerprint = job_fingerprint(parts)
+        return {
+            'last_ayah': last_ayah,
+            'seed': seed,
+            'backgrounds': backgrounds,
+            'offsets': offsets,
+            'fingerprint': fingerprint
+        }
+
     def stop(self):
-        """Signal to stop generation"""
+        """Signal to stop generation, aborting any in-flight download or encode"""
         self.should_stop = True
+        self.cancel_token.cancel()
 
-    def generate_video(self, reciter_id, surah, start_ayah, end_ayah=None):
+    def generate_video(self, reciter_id, surah, start_ayah, end_ayah=None, ayah_gap=0.0,
+                       seed=None, background_mode='per_ayah', formats=None, live_id=None,
+                       profile=False, deadline=None, cancel=None):
         """
         Main video generation method.
+        ayah_gap: optional silence (seconds) inserted between ayahs in the mixed track.
+        seed: optional background seed; identical jobs reuse the already rendered video.
+        background_mode: 'per_ayah' or 'continuous' (one background for the whole reel).
+        formats: optional list of OUTPUT_FORMATS keys; the reel is composed once and
+        encoded to each format, the first one at output_path and the rest beside it
+        (see output_variants).
+        live_id: optional id for a live render; the video is then written as fragmented
+        MP4 to live_output_path(out_dir, live_id), playable while it encodes, and
+        moved into the video folder once complete.
+        profile: run the job under cProfile and save the stats next to the video
+        (profile_path_for), or in outputs/profiles if no video was rendered; the
+        path is left in self.profile_path. A profiled job always renders, even if
+        an identical video exists. Only the calling thread is profiled; parallel
+        ayah fetches show up as waits.
+        deadline: optional end-to-end limit in seconds (default JOB_DEADLINE), split
+        into stage budgets; a stage that overruns fails the job with StageTimeout.
+        cancel: optional CancelToken to run the job under (default: a new one),
+        for callers that cancel jobs from another thread.
         Returns: (success: bool, output_path: str or None, error: str or None)
         """
         self.is_running = True
         self.should_stop = False
+        self.cancel_token = cancel or CancelToken()
+        cancel = self.cancel_token
         output_path = None
+        clips = []
+        bg_clips = []
+        temp_text_images = []
+        stage_started = time.perf_counter()
+        self.profile_path = None
+        profiler = cProfile.Profile() if profile else None
+        if profiler is not None:
+            profiler.enable()
+        # Fails the job through the cancel token once the process outgrows its budget
+        memory = self.memory = MemoryMonitor(
+            self.memory_budget_mb * MB, trace_allocations=TRACE_ALLOCATIONS, on_exceeded=cancel.abort
+        ).start()
+        degraded = []
+        deadline = JOB_DEADLINE if deadline is None else deadline
+        job_deadline = self.job_deadline = JobDeadline(deadline, cancel) if deadline else None
+        if job_deadline is not None:
+            self.add_log(f'[deadline] Job deadline {deadline:g}s; '
+                         f"prepare: {job_deadline.begin('prepare'):.1f}s budget")
         
         try:
+            elapsed = load_media_modules()
+            if elapsed:
+                self.add_log(f'[0] Media engine loaded in {elapsed:.2f}s')
+            
             self.add_log('[1] Clearing output folders...')
             self.update_progress(5, 'جاري تنظيف ملفات الإخراج...')
             
@@ -298,123 +1627,225 @@ class VideoGenerator:
                 shutil.rmtree(self.audio_dir)
                 os.makedirs(self.audio_dir, exist_ok=True)
             
-            max_ayah = VERSE_COUNTS[surah]
-            
-            # Determine end ayah
-            if end_ayah is None:
-                last_ayah = min(start_ayah + 9, max_ayah)
-            else:
-                last_ayah = min(end_ayah, max_ayah)
+            plan = self.plan_job(reciter_id, surah, start_ayah, end_ayah, ayah_gap, seed,
+                                 background_mode, formats)
+            last_ayah = plan['last_ayah']
             
-            if last_ayah < start_ayah:
-                last_ayah = start_ayah
+            # A profiled job is run to be measured, not answered from the index
+            existing = None if profile else self.output_index.lookup(plan['fingerprint'])
+            if existing and formats and not all(
+                    os.path.isfile(p) for p in output_variants(existing, formats).values()):
+                existing = None
+            stage_started = self.end_stage('prepare', stage_started)
+            if existing:
+                self.add_log(f'[2] Identical video already rendered → {existing}')
+                self.update_progress(100, 'تم بنجاح!')
+                return True, existing, None
             
             total = last_ayah - start_ayah + 1
             
             self.add_log(f'[2] Preparing {total} verses (from {start_ayah} to {last_ayah})')
             self.update_progress(10, f'جاري تحضير {total} آيات...')
             
-            clips = []
-            temp_text_images = []
+            def fetch_ayah(idx, ayah):
+                cancel.check()
+                audio_path = self.download_audio(reciter_id, surah, ayah, idx)
+                samples = self.load_audio_samples(audio_path)
+                return samples, self.get_ayah_text(surah, ayah)
             
-            for idx, ayah in enumerate(range(start_ayah, last_ayah + 1), start=1):
-                if self.should_stop:
-                    self.add_log('Generation stopped by user')
-                    self.update_progress(0, 'تم الإلغاء')
-                    return False, None, "Cancelled by user"
-                
-                progress_per_ayah = 70 / total
-                base_progress = 10 + (idx - 1) * progress_per_ayah
-                
-                # Download audio
-                self.add_log(f'[3.{idx}] Downloading audio for verse {ayah}')
-                self.update_progress(
-                    int(base_progress + progress_per_ayah * 0.3),
-                    f'جاري تحميل صوت الآية {ayah}...'
-                )
-                audio_path = self.download_audio(reciter_id, surah, ayah, idx - 1)
-                
-                # Get text
-                self.add_log(f'[3.{idx}] Fetching text')
-                self.update_progress(
-                    int(base_progress + progress_per_ayah * 0.5),
-                    f'جاري جلب نص الآية {ayah}...'
-                )
-                arabic_text = self.get_ayah_text(surah, ayah)
-                
-                # Load audio to get duration
-                audio_clip = AudioFileClip(audio_path).audio_fadein(0.2).audio_fadeout(0.2)
-                duration = audio_clip.duration
+            # Fetch ayahs concurrently; upstream.py keeps each host's load adaptive
+            self.add_log(f'[3] Downloading audio and text for {total} verses')
+            fetch_workers = min(FETCH_WORKERS, total)
+            headroom = memory.headroom()
+            if headroom is not None and headroom < fetch_workers * FETCH_MEMORY_MB * MB:
+                fetch_workers = max(1, int(headroom // (FETCH_MEMORY_MB * MB)))
+                self.add_log(f'[mem] {headroom / MB:.0f} MB headroom: fetching {fetch_workers} ayahs at a time')
+            threads = self.cpu_threads('fetch')
+            if threads:
+                # Each fetch decodes its MP3; downloads wait on the network half the time
+                fetch_workers = min(fetch_workers, 2 * threads)
+            fetched = [None] * total
+            with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+                futures = {
+                    pool.submit(fetch_ayah, idx, ayah): idx
+                    for idx, ayah in enumerate(range(start_ayah, last_ayah + 1))
+                }
+                try:
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        idx = futures[future]
+                        fetched[idx] = future.result()
+                        self.add_log(f'[3.{idx + 1}] Fetched verse {start_ayah + idx}')
+                        self.update_progress(
+                            int(10 + 55 * done / total),
+                            f'جاري تحميل الآيات ({done}/{total})...'
+                        )
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+            limits = ', '.join(f"{host}={m['limit']}" for host, m in upstream.metrics().items())
+            if limits:
+                self.add_log(f'[3] Upstream concurrency limits: {limits}')
+            
+            # Text overlays using Pillow-rendered images
+            audio_parts = []
+            for samples, arabic_text in fetched:
+                audio_parts.append(samples)
+                text_img_path, _ = self.render_text_to_image(arabic_text)
+                temp_text_images.append(text_img_path)
+            
+            stage_started = self.end_stage('fetch', stage_started)
+            
+            # Mix the whole reel's audio once; segment timing comes from the same buffer
+            self.add_log('[3] Mixing audio track...')
+            self.update_progress(70, 'جاري دمج الصوت...')
+            gains = normalize_loudness(audio_parts)
+            self.add_log(f'[3] Loudness normalized (gain {min(gains):+.1f} to {max(gains):+.1f} dB)')
+            audio_buffer, durations = premix_audio(audio_parts, gap=ayah_gap)
+            audio_track = AudioArrayClip(audio_buffer, fps=AUDIO_FPS)
+            stage_started = self.end_stage('mix', stage_started)
+            
+            # Under memory pressure, compose with fewer decoders and smaller frames
+            cancel.check()
+            usage = memory.usage()
+            if background_mode == 'per_ayah' and total > 1 and usage >= DEGRADE_CONTINUOUS_AT:
+                background_mode = 'continuous'
+                degraded.append('one continuous background')
+            frame_scale = 0.5 if usage >= DEGRADE_RESOLUTION_AT else 1.0
+            if frame_scale != 1.0:
+                degraded.append('half resolution')
+                for text_img_path in temp_text_images:
+                    scale_image_file(text_img_path, frame_scale)
+            if degraded:
+                self.add_log(f'[mem] {usage:.0%} of the memory budget in use; degrading to '
+                             + ', '.join(degraded))
+            background_sizes = [
+                scaled_size(self.get_background_index().get(bg)['frame_size'], frame_scale)
+                if frame_scale != 1.0 else None
+                for bg in plan['backgrounds']
+            ]
+            # Decoders run alongside the encoder and only need to keep it fed;
+            # the encoder gets the rest of the job's share (see cpu_budget.split_threads)
+            threads = self.cpu_threads('compose')
+            decoder_threads = split_threads(threads)[0] if threads else None
+            
+            if background_mode == 'continuous':
+                # One reader decodes a single background sequentially under every ayah,
+                # looping only at the background's real end
+                self.add_log('[4] Compositing over one continuous background...')
+                self.update_progress(80, 'جاري دمج المقاطع...')
+                bg_clip, bg_source = open_background(plan['backgrounds'][0], plan['offsets'][0],
+                                                     background_sizes[0], decoder_threads)
+                bg_clips.append(bg_source)
+                layers = [bg_clip.fx(vfx_loop, duration=sum(durations))]
                 
-                # Build segment
-                self.add_log(f'[3.{idx}] Building segment')
-                self.update_progress(
-                    int(base_progress + progress_per_ayah * 0.8),
-                    f'جاري إنشاء مقطع الآية {ayah}...'
-                )
+                starts = np.concatenate(([0.0], np.cumsum(durations)[:-1]))
+                for start, duration, text_img_path in zip(starts, durations, temp_text_images):
+                    text_clip = ImageClip(text_img_path).set_start(float(start)).set_duration(duration)
+                    layers.append(text_clip.set_position('center'))
+                final = CompositeVideoClip(layers)
+            else:
+                for idx, (duration, text_img_path) in enumerate(zip(durations, temp_text_images), start=1):
+                    cancel.check()
                 
-                # Background video
-                bg_path = self.pick_background()
-                bg_clip = VideoFileClip(bg_path)
-                seg_bg = bg_clip.fx(vfx.loop, duration=duration).subclip(0, duration)
+                    # Build segment
+                    self.add_log(f'[3.{idx}] Building segment')
+                    self.update_progress(
+                        int(70 + 10 * idx / total),
+                        f'جاري إنشاء مقطع الآية {start_ayah + idx - 1}...'
+                    )
                 
-                # Text overlay using Pillow-rendered image
-                text_img_path, _ = self.render_text_to_image(arabic_text)
-                temp_text_images.append(text_img_path)
+                    # Background video, opened at its keyframe offset
+                    bg_clip, bg_source = open_background(plan['backgrounds'][idx - 1],
+                                                         plan['offsets'][idx - 1],
+                                                         background_sizes[idx - 1], decoder_threads)
+                    bg_clips.append(bg_source)
+                    seg_bg = bg_clip.fx(vfx_loop, duration=duration).subclip(0, duration)
                 
-                text_clip = ImageClip(text_img_path).set_duration(duration)
-                # Center the text
-                text_clip = text_clip.set_position('center')
+                    text_clip = ImageClip(text_img_path).set_duration(duration)
+                    # Center the text
+                    text_clip = text_clip.set_position('center')
                 
-                # Composite
-                seg = CompositeVideoClip([seg_bg, text_clip]).set_audio(audio_clip)
-                clips.append(seg)
+                    # Composite (audio is attached once to the final clip)
+                    seg = CompositeVideoClip([seg_bg, text_clip])
+                    clips.append(seg)
                 
-                # Clean up background clip
-                bg_clip.close()
+                # Concatenate
+                self.add_log('[4] Concatenating segments...')
+                self.update_progress(85, 'جاري دمج المقاطع...')
+                final = concatenate_videoclips(clips, method='compose')
             
-            # Concatenate
-            self.add_log('[4] Concatenating segments...')
-            self.update_progress(85, 'جاري دمج المقاطع...')
-            final = concatenate_videoclips(clips, method='compose')
+            final = final.set_audio(audio_track.set_duration(final.duration))
+            clips.append(final)
+            stage_started = self.end_stage('compose', stage_started)
             
             # Generate output filename
             from datetime import datetime
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             surah_name = SURAH_NAMES[surah - 1]
-            filename = f"QuranReel_{surah_name}_{start_ayah}-{last_ayah}_{timestamp}.mp4"
+            filename = f"QuranReel_{surah_name}_{start_ayah}-{last_ayah}_{timestamp}_{plan['fingerprint'][:8]}.mp4"
             output_path = os.path.join(self.video_dir, filename)
             
             self.add_log(f'[5] Writing final video → {output_path}')
             self.update_progress(90, 'جاري كتابة الفيديو النهائي...')
             
-            final.write_videofile(
-                output_path,
-                fps=24,
-                codec='libx264',
-                audio_codec='aac',
-                audio_bitrate='192k',
-                verbose=False,
-                ffmpeg_params=['-movflags', '+faststart']
-            )
+            paths = output_variants(output_path, formats or [None])
+            ffmpeg_params = ENCODER_PROFILE['ffmpeg_params']
+            live_path = None
+            if live_id:
+                live_path = live_output_path(self.out_dir, live_id)
+                os.makedirs(os.path.dirname(live_path), exist_ok=True)
+                paths[next(iter(paths))] = live_path
+                ffmpeg_params = LIVE_FFMPEG_PARAMS
+                self.add_log(f'[5] Live output → {live_path}')
             
-            # Clean up clips
-            for clip in clips:
-                clip.close()
-            final.close()
+            threads = self.cpu_threads('encode')
+            encoder_threads = max(1, threads - decoder_threads) if threads else None
             
-            # Clean up temp text images
-            for temp_img in temp_text_images:
-                try:
-                    os.unlink(temp_img)
-                except:
-                    pass
+            variants = None
+            if formats:
+                variants = [
+                    (path, format_filter(final.size, fmt), OUTPUT_FORMATS[fmt]['bitrate'])
+                    for fmt, path in paths.items()
+                ]
+                self.add_log(f'[5] Encoding {len(variants)} formats from one pass: '
+                             + ', '.join(f'{fmt} ({vf})' for fmt, (_, vf, _) in zip(formats, variants)))
+            
+            write_video(
+                final,
+                live_path or output_path,
+                fps=ENCODER_PROFILE['fps'],
+                audio_fps=ENCODER_PROFILE['audio_fps'],
+                audio_bitrate=ENCODER_PROFILE['audio_bitrate'],
+                ffmpeg_params=ffmpeg_params,
+                cancel=cancel,
+                progress_callback=lambda f: self.update_progress(
+                    90 + int(9 * f), 'جاري كتابة الفيديو النهائي...'
+                ),
+                variants=variants,
+                threads=encoder_threads
+            )
+            if live_path:
+                # POSIX readers keep their open handle across the move
+                if not publish_live_output(live_path, output_path):
+                    self.add_log('[5] Live file still being streamed; copied, removed when readers finish')
+            if degraded:
+                # Not the video the fingerprint describes; let a later run render it properly
+                self.add_log('[mem] Degraded render not recorded for reuse')
+            else:
+                self.output_index.record(plan['fingerprint'], output_path)
+            self.end_stage('encode', stage_started)
             
             self.add_log('[6] Done!')
             self.update_progress(100, 'تم بنجاح!')
             
             return True, output_path, None
             
+        except GenerationCancelled:
+            self.add_log('Generation stopped by user')
+            self.update_progress(0, 'تم الإلغاء')
+            return False, None, "Cancelled by user"
+            
         except Exception as e:
             error_msg = f"Error in generate_video: {str(e)}"
             self.logger.error(f"{error_msg}\n{traceback.format_exc()}")
@@ -423,12 +1854,48 @@ class VideoGenerator:
             return False, None, str(e)
             
         finally:
+            # Clean up clips and temp text images
+            for clip in clips + bg_clips:
+                clip.close()
+            for temp_img in temp_text_images:
+                try:
+                    os.unlink(temp_img)
+                except:
+                    pass
+            if profiler is not None:
+                profiler.disable()
+                self.profile_path = self.save_profile(profiler, output_path)
+            memory.stop()
+            self.memory = None
+            if job_deadline is not None:
+                job_deadline.stop()
+                self.job_deadline = None
+            if memory.peaks:
+                self.add_log('[mem] Peak RSS by stage: ' + ', '.join(
+                    f"{name}={peak['rss_mb']:.0f}MB" for name, peak in memory.peaks.items()))
             self.is_running = False
+    
+    def save_profile(self, profiler, output_path=None):
+        """Write a job's profile next to its video (or to outputs/profiles); returns the path"""
+        if output_path and os.path.isfile(output_path):
+            path = profile_path_for(output_path)
+        else:
+            from datetime import datetime
+            profiles_dir = os.path.join(self.out_dir, 'profiles')
+            os.makedirs(profiles_dir, exist_ok=True)
+            path = os.path.join(profiles_dir, datetime.now().strftime('%Y%m%d_%H%M%S_%f') + '.prof')
+        try:
+            profiler.dump_stats(path)
+        except OSError as e:
+            self.logger.error(f"Failed to save profile to {path}: {e}")
+            return None
+        self.add_log(f'[profile] Saved → {path}')
+        return path
 
 
 # Convenience function for simple usage
 def generate_quran_video(reciter_id, surah, start_ayah, end_ayah=None, 
-                         progress_callback=None, log_callback=None):
+                         progress_callback=None, log_callback=None, ayah_gap=0.0, seed=None):
     """
     Simple function to generate a Quran video.
     
@@ -439,6 +1906,8 @@ def generate_quran_video(reciter_id, surah, start_ayah, end_ayah=None,
         end_ayah: Ending verse number (optional, defaults to start+9)
         progress_callback: Function(percent, status) to call with progress updates
         log_callback: Function(message) to call with log messages
+        ayah_gap: Silence in seconds inserted between verses (optional)
+        seed: Background seed (optional); identical jobs reuse the rendered video
     
     Returns:
         tuple: (success: bool, output_path: str or None, error: str or None)
@@ -447,4 +1916,5 @@ def generate_quran_video(reciter_id, surah, start_ayah, end_ayah=None,
         progress_callback=progress_callback,
         log_callback=log_callback
     )
-    return generator.generate_video(reciter_id, surah, start_ayah, end_ayah)
+    return generator.generate_video(reciter_id, surah, start_ayah, end_ayah,
+                                    ayah_gap=ayah_gap, seed=seed)
@@ -0,0 +1,450 @@
+"""
+Quran Reels Generator - Shared Job Store
+Jobs submitted by the server are leased by render workers, which may run in
+any number of processes sharing the store. A worker keeps its lease alive with
+heartbeats; if it dies, the lease times out and another worker picks the job up.
+
+open_job_store() selects the backend from a spec string; SQLiteJobStore is
+the local implementation. It runs in WAL mode, which needs shared memory and
+reliable file locks, so the database must sit on a local disk of the one host
+all its processes run on (not SMB or NFS). Spreading workers over several
+machines takes a networked JobStore backend.
+The store doubles as the job history: records keep each job's inputs, status,
+per-stage timings, output path, error and log after it finishes.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobStore(ABC):
+    """
+    Interface every job store backend implements.
+    Job records are dicts with: id, params, status, worker, attempts, progress,
+    status_text, output_path, error, cancel_requested, created, started, finished,
+    profile_path and timings ({stage: seconds}).
+    A lease_seconds of None means the lease never expires (the job's owner is
+    the process that records it, e.g. the server rendering locally).
+    """
+
+    @abstractmethod
+    def submit(self, params, worker_id=None):
+        """
+        Queue a job (keyword arguments for generate_video); returns its id.
+        With worker_id the job is recorded as already running on that worker.
+        """
+
+    @abstractmethod
+    def lease(self, worker_id, lease_seconds):
+        """Claim the oldest runnable job for worker_id; returns the record or None"""
+
+    @abstractmethod
+    def recover(self, worker_id, requeue=False):
+        """
+        Deal with jobs left running by a worker that restarted: requeue them,
+        or mark them failed. Returns the affected job ids.
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id, worker_id, lease_seconds, progress=None, status_text=None):
+        """Extend the lease and report progress; returns False if the lease was lost"""
+
+    @abstractmethod
+    def finish(self, job_id, worker_id, status, output_path=None, error=None):
+        """Record the outcome of a leased job; returns False if the lease was lost"""
+
+    @abstractmethod
+    def request_cancel(self, job_id):
+        """Cancel a queued job, or ask the worker running it to stop"""
+
+    @abstractmethod
+    def get(self, job_id):
+        """Return the job record, or None"""
+
+    @abstractmethod
+    def list_jobs(self, offset=0, limit=20, status=None):
+        """Return (records, total) for jobs newest first, optionally filtered by status"""
+
+    @abstractmethod
+    def record_stage(self, job_id, stage, seconds):
+        """Store how long a pipeline stage of a job took"""
+
+    @abstractmethod
+    def record_profile(self, job_id, path):
+        """Store where a profiled job's cProfile stats were saved"""
+
+    @abstractmethod
+    def log(self, job_id, message):
+        """Append a log line to a job"""
+
+    @abstractmethod
+    def logs(self, job_id, after=0):
+        """Return [(log_id, message)] for a job's log lines newer than `after`"""
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Job store in a SQLite database; safe to share between processes on one host.
+    The database records the host using it and refuses to open on another host
+    while that one holds live leases.
+    """
+
+    COLUMNS = ('id', 'params', 'status', 'worker', 'lease_until', 'attempts', 'progress',
+               'status_text', 'output_path', 'error', 'cancel_requested',
+               'created', 'started', 'finished', 'profile_path')
+
+    def __init__(self, path, max_attempts=3):
+        """max_attempts: leases a job may get before an expired lease fails it"""
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.abspath(path).startswith(('\\\\', '//')):
+            raise ValueError(f"SQLite job store {path} is on a network share; "
+                             f"SQLite stores must be on a local disk")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY, params TEXT NOT NULL, status TEXT NOT NULL,'
+                ' worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,'
+                ' progress INTEGER NOT NULL DEFAULT 0, status_text TEXT,'
+                ' output_path TEXT, error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0,'
+                ' created REAL NOT NULL, started REAL, finished REAL, profile_path TEXT);'
+                'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);'
+                'CREATE TABLE IF NOT EXISTS job_logs ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL,'
+                ' ts REAL NOT NULL, message TEXT NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS job_logs_job ON job_logs (job_id, id);'
+                'CREATE TABLE IF NOT EXISTS job_stages ('
+                ' job_id TEXT NOT NULL, stage TEXT NOT NULL, seconds REAL NOT NULL,'
+                ' PRIMARY KEY (job_id, stage));'
+                'CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);'
+                'CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT);'
+            )
+            host = socket.gethostname()
+            conn.execute("INSERT OR IGNORE INTO store_meta VALUES ('host', ?)", (host,))
+            owner = conn.execute("SELECT value FROM store_meta WHERE key = 'host'").fetchone()[0]
+            if owner != host:
+                # A store moved with the app folder is adopted; one in use elsewhere is not
+                leased = conn.execute('SELECT COUNT(*) FROM jobs WHERE status = ? AND lease_until > ?',
+                                      (RUNNING, time.time())).fetchone()[0]
+                if leased:
+                    raise ValueError(f"SQLite job store {path} is in use on host {owner}; "
+                                     f"SQLite stores cannot be shared between machines")
+                logging.warning(f"Job store {path} moved from host {owner}; adopting it")
+                conn.execute("UPDATE store_meta SET value = ? WHERE key = 'host'", (host,))
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+            if 'profile_path' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN profile_path TEXT')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _row(self, row, timings=None):
+        if row is None:
+            return None
+        record = dict(zip(self.COLUMNS, row))
+        record['params'] = json.loads(record['params'])
+        record['cancel_requested'] = bool(record['cancel_requested'])
+        record['timings'] = timings or {}
+        return record
+
+    def _timings(self, conn, job_ids):
+        timings = {job_id: {} for job_id in job_ids}
+        if job_ids:
+            rows = conn.execute(
+                f'SELECT job_id, stage, seconds FROM job_stages'
+                f' WHERE job_id IN ({", ".join("?" * len(job_ids))})', job_ids
+            ).fetchall()
+            for job_id, stage, seconds in rows:
+                timings[job_id][stage] = seconds
+        return timings
+
+    def submit(self, params, worker_id=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            if worker_id is None:
+                conn.execute(
+                    'INSERT INTO jobs (id, params, status, created) VALUES (?, ?, ?, ?)',
+                    (job_id, json.dumps(params, ensure_ascii=False), QUEUED, now)
+                )
+            else:
+                conn.execute(
+                    'INSERT INTO jobs (id, params, status, worker, attempts, created, started)'
+                    ' VALUES (?, ?, ?, ?, 1, ?, ?)',
+                    (job_id, json.dumps(params, ensure_ascii=False), RUNNING, worker_id, now, now)
+                )
+        finally:
+            conn.close()
+        return job_id
+
+    def lease(self, worker_id, lease_seconds=30):
+        now = time.time()
+        conn = self._connect()
+        try:
+            # IMMEDIATE takes the write lock up front so two workers never claim the same job
+            conn.execute('BEGIN IMMEDIATE')
+            expired = conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, finished = ?'
+                ' WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'Worker lease expired too many times', now, RUNNING, now, self.max_attempts)
+            ).rowcount
+            if expired:
+                logging.warning(f"Job store: failed {expired} job(s) after repeated lease expiry")
+            row = conn.execute(
+                'SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?)'
+                ' ORDER BY created LIMIT 1',
+                (QUEUED, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1,'
+                ' started = COALESCE(started, ?) WHERE id = ?',
+                (RUNNING, worker_id, None if lease_seconds is None else now + lease_seconds,
+                 now, row[0])
+            )
+            record = conn.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM jobs WHERE id = ?', (row[0],)
+            ).fetchone()
+            timings = self._timings(conn, [row[0]])[row[0]]
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return self._row(record, timings)
+
+    def recover(self, worker_id, requeue=False):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            job_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM jobs WHERE worker = ? AND status = ?', (worker_id, RUNNING)
+            )]
+            now = time.time()
+            for job_id in job_ids:
+                if requeue:
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL,'
+                        ' progress = 0, cancel_requested = 0 WHERE id = ?', (QUEUED, job_id)
+                    )
+                    message = 'Requeued after an interrupted run'
+                else:
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?',
+                        (FAILED, 'Interrupted by a restart', now, job_id)
+                    )
+                    message = 'Interrupted by a restart'
+                conn.execute('INSERT INTO job_logs (job_id, ts, message) VALUES (?, ?, ?)',
+                             (job_id, now, message))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return job_ids
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=30, progress=None, status_text=None):
+        conn = self._connect()
+        try:
+            updated = conn.execute(
+                'UPDATE jobs SET lease_until = ?, progress = COALESCE(?, progress),'
+                ' status_text = COALESCE(?, status_text)'
+                ' WHERE id = ? AND worker = ? AND status = ?',
+                (None if lease_seconds is None else time.time() + lease_seconds,
+                 progress, status_text, job_id, worker_id, RUNNING)
+            ).rowcount
+        finally:
+            conn.close()
+        return updated == 1
+
+    def finish(self, job_id, worker_id, status, output_path=None, error=None):
+        conn = self._connect()
+        try:
+            updated = conn.execute(
+                'UPDATE jobs SET status = ?, output_path = ?, error = ?, finished = ?,'
+                ' progress = CASE WHEN ? = ? THEN 100 ELSE progress END, lease_until = NULL'
+                ' WHERE id = ? AND worker = ? AND status = ?',
+                (status, output_path, error, time.time(), status, DONE, job_id, worker_id, RUNNING)
+            ).rowcount
+        finally:
+            conn.close()
+        return updated == 1
+
+    def request_cancel(self, job_id):
+        conn = self._connect()
+        try:
+            conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ? AND status = ?',
+                (CANCELLED, 'Cancelled by user', time.time(), job_id, QUEUED)
+            )
+            conn.execute(
+                'UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?',
+                (job_id, RUNNING)
+            )
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+            timings = self._timings(conn, [job_id])[job_id]
+        finally:
+            conn.close()
+        return self._row(row, timings)
+
+    def list_jobs(self, offset=0, limit=20, status=None):
+        where, args = ('WHERE status = ?', [status]) if status else ('', [])
+        conn = self._connect()
+        try:
+            total = conn.execute(f'SELECT COUNT(*) FROM jobs {where}', args).fetchone()[0]
+            rows = conn.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM jobs {where}'
+                f' ORDER BY created DESC LIMIT ? OFFSET ?', args + [limit, offset]
+            ).fetchall()
+            timings = self._timings(conn, [row[0] for row in rows])
+        finally:
+            conn.close()
+        return [self._row(row, timings[row[0]]) for row in rows], total
+
+    def record_stage(self, job_id, stage, seconds):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO job_stages VALUES (?, ?, ?)',
+                         (job_id, stage, seconds))
+        finally:
+            conn.close()
+
+    def record_profile(self, job_id, path):
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE jobs SET profile_path = ? WHERE id = ?', (path, job_id))
+        finally:
+            conn.close()
+
+    def log(self, job_id, message):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO job_logs (job_id, ts, message) VALUES (?, ?, ?)',
+                         (job_id, time.time(), message))
+        finally:
+            conn.close()
+
+    def logs(self, job_id, after=0):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                'SELECT id, message FROM job_logs WHERE job_id = ? AND id > ? ORDER BY id',
+                (job_id, after)
+            ).fetchall()
+        finally:
+            conn.close()
+
+
+def open_job_store(spec):
+    """
+    Open a job store from a spec string:
+      sqlite:///path/to/jobs.sqlite  (or a plain path ending in .sqlite/.db)
+    """
+    if spec.startswith('sqlite:///'):
+        return SQLiteJobStore(spec[len('sqlite:///'):])
+    if spec.endswith(('.sqlite', '.db')):
+        return SQLiteJobStore(spec)
+    raise ValueError(f"Unknown job store: {spec}")
+
+
+class StoreDispatcher:
+    """
+    Runs jobs through a shared job store instead of local workers.
+    Same interface as WorkerPool: run() blocks until some worker finishes the
+    job, relaying its progress and log lines through the callbacks.
+    """
+
+    def __init__(self, store, poll_interval=0.5):
+        self.store = store
+        self.poll_interval = poll_interval
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def upstream_metrics(self):
+        """Store workers run elsewhere; their upstream limits are in each job's log"""
+        return {}
+
+    def cpu_metrics(self):
+        """Store workers share their own machines' cores"""
+        return {}
+
+    def run(self, job, progress_callback=None, log_callback=None, cancel=None, stage_callback=None,
+            profile_callback=None):
+        """
+        Submit a job and wait for it.
+        Stage timings and profile paths are recorded in the store by the worker, so
+        stage_callback and profile_callback are unused.
+        Returns: (success: bool, output_path: str or None, error: str or None)
+        """
+        job_id = self.store.submit(job)
+        logging.info(f"Queued job {job_id} in the job store")
+        return self.wait(job_id, progress_callback, log_callback, cancel)
+
+    def wait(self, job_id, progress_callback=None, log_callback=None, cancel=None):
+        """Follow an already submitted job until it finishes; returns like run()"""
+        progress_callback = progress_callback or (lambda p, s: None)
+        log_callback = log_callback or (lambda m: None)
+        last_log = 0
+        last_progress = None
+        cancel_sent = False
+
+        while True:
+            if cancel is not None and cancel.cancelled and not cancel_sent:
+                self.store.request_cancel(job_id)
+                cancel_sent = True
+
+            for last_log, message in self.store.logs(job_id, last_log):
+                log_callback(message)
+
+            record = self.store.get(job_id)
+            progress = (record['progress'], record['status_text'])
+            if record['status_text'] and progress != last_progress:
+                progress_callback(*progress)
+                last_progress = progress
+
+            if record['status'] in FINISHED_STATES:
+                # Pick up log lines written just before the job finished
+                for last_log, message in self.store.logs(job_id, last_log):
+                    log_callback(message)
+                return record['status'] == DONE, record['output_path'], record['error']
+
+            time.sleep(self.poll_interval)
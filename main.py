@@ -3,15 +3,18 @@
 
 import os
 import sys
-import shutil
-import random
+import time
+import atexit
+import socket
 import threading
+import multiprocessing
 import webbrowser
 import json
-import datetime
 import logging
 import traceback
-from flask import Flask, request, jsonify, send_file, send_from_directory
+import math
+from flask import Flask, Response, request, jsonify, send_file
+from werkzeug.security import safe_join
 from flask_cors import CORS
 
 # --- Step: Path Resolution Functions ---
@@ -31,22 +34,8 @@ def bundled_dir():
 EXEC_DIR = app_dir()
 BUNDLE_DIR = bundled_dir()
 
-# --- Step: Setup Logging ---
-log_path = os.path.join(EXEC_DIR, "runlog.txt")
-logging.basicConfig(filename=log_path, level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s', force=True)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-logging.getLogger().addHandler(console_handler)
-
-logging.info("--- Starting Quran Reels Generator ---")
-logging.info(f"Execution Directory: {EXEC_DIR}")
-logging.info(f"Bundled Directory: {BUNDLE_DIR}")
-
 # --- Step: Define Paths ---
 FFMPEG_EXE = os.path.join(BUNDLE_DIR, "bin", "ffmpeg", "ffmpeg.exe")
-IM_MAGICK_EXE = os.path.join(BUNDLE_DIR, "bin", "imagemagick", "magick.exe")
-IM_HOME = os.path.join(BUNDLE_DIR, "bin", "imagemagick")
 
 VISION_DIR = os.path.join(BUNDLE_DIR, "vision")
 UI_PATH = os.path.join(BUNDLE_DIR, "UI.html")
@@ -60,107 +49,107 @@ FONT_PATH = os.path.join(FONT_DIR, "DUBAI-MEDIUM.TTF")
 FONT_PATH_ARABIC = os.path.join(FONT_DIR, "DUBAI-BOLD.TTF")
 FONT_PATH_ENGLISH = os.path.join(FONT_DIR, "DUBAI-REGULAR.TTF")
 
-# Create folders on startup
-try:
-    os.makedirs(AUDIO_DIR, exist_ok=True)
-    os.makedirs(VIDEO_DIR, exist_ok=True)
-    os.makedirs(FONT_DIR, exist_ok=True)
-    logging.info("Output and Font directories verified.")
-except Exception as e:
-    logging.error(f"Failed to create directories: {e}")
-
-# Validate Bundled Requirements
-if not os.path.isfile(FFMPEG_EXE): logging.error(f"Missing ffmpeg.exe at {FFMPEG_EXE}")
-if not os.path.isfile(IM_MAGICK_EXE): logging.error(f"Missing magick.exe at {IM_MAGICK_EXE}")
-if not os.path.isdir(VISION_DIR): logging.error(f"Missing vision folder at {VISION_DIR}")
-if not os.path.isfile(UI_PATH): logging.error(f"Missing UI.html at {UI_PATH}")
-
-# --- Step: Configure Environment Variables ---
-os.environ["FFMPEG_BINARY"] = FFMPEG_EXE
-os.environ["IMAGEIO_FFMPEG_EXE"] = FFMPEG_EXE
-
-# ImageMagick Environment Setup
-os.environ["IMAGEMAGICK_BINARY"] = IM_MAGICK_EXE
-os.environ["MAGICK_HOME"] = IM_HOME
-os.environ["MAGICK_CONFIGURE_PATH"] = os.path.join(IM_HOME, "config")
-# Pre-flight check: if config dir missing, fallback to root or modules
-if not os.path.exists(os.environ["MAGICK_CONFIGURE_PATH"]):
-    os.environ["MAGICK_CONFIGURE_PATH"] = IM_HOME # Portable versions often have xmls in root
-
-os.environ["MAGICK_CODER_MODULE_PATH"] = os.path.join(IM_HOME, "modules", "coders") # Typical path
-if not os.path.exists(os.environ["MAGICK_CODER_MODULE_PATH"]):
-    os.environ["MAGICK_CODER_MODULE_PATH"] = os.path.join(IM_HOME, "modules")
-
-# Prepend PATH for DLL discovery
-os.environ["PATH"] = os.pathsep.join([
-    os.path.dirname(FFMPEG_EXE),
-    IM_HOME,
-    os.environ.get("PATH", "")
-])
-
-logging.info("Environment variables set for portable binaries.")
-
-import requests as http_requests
-from pydub import AudioSegment
-AudioSegment.converter = FFMPEG_EXE
-AudioSegment.ffmpeg = FFMPEG_EXE
-AudioSegment.ffprobe = os.path.join(os.path.dirname(FFMPEG_EXE), "ffprobe.exe")
-
-from moviepy.config import change_settings
-try:
-    change_settings({"FFMPEG_BINARY": FFMPEG_EXE, "IMAGEMAGICK_BINARY": IM_MAGICK_EXE})
-except Exception as e:
-    logging.error(f"MoviePy config error: {e}")
-
-from moviepy.editor import VideoFileClip, AudioFileClip, TextClip, CompositeVideoClip, concatenate_videoclips
-import moviepy.video.fx.all as vfx
-
-# Verse counts for each Surah
-VERSE_COUNTS = {
-    1: 7, 2: 286, 3: 200, 4: 176, 5: 120, 6: 165, 7: 206, 8: 75, 9: 129, 10: 109,
-    11: 123, 12: 111, 13: 43, 14: 52, 15: 99, 16: 128, 17: 111, 18: 110, 19: 98, 20: 135,
-    21: 112, 22: 78, 23: 118, 24: 64, 25: 77, 26: 227, 27: 93, 28: 88, 29: 69, 30: 60,
-    31: 34, 32: 30, 33: 73, 34: 54, 35: 45, 36: 83, 37: 182, 38: 88, 39: 75, 40: 85,
-    41: 54, 42: 53, 43: 89, 44: 59, 45: 37, 46: 35, 47: 38, 48: 29, 49: 18, 50: 45,
-    51: 60, 52: 49, 53: 62, 54: 55, 55: 78, 56: 96, 57: 29, 58: 22, 59: 24, 60: 13,
-    61: 14, 62: 11, 63: 11, 64: 18, 65: 12, 66: 12, 67: 30, 68: 52, 69: 52, 70: 44,
-    71: 28, 72: 28, 73: 20, 74: 56, 75: 40, 76: 31, 77: 50, 78: 40, 79: 46, 80: 42,
-    81: 29, 82: 19, 83: 36, 84: 25, 85: 22, 86: 17, 87: 19, 88: 26, 89: 30, 90: 20,
-    91: 15, 92: 21, 93: 11, 94: 8, 95: 8, 96: 19, 97: 5, 98: 8, 99: 8, 100: 11,
-    101: 11, 102: 8, 103: 3, 104: 9, 105: 5, 106: 4, 107: 7, 108: 3, 109: 6, 110: 3,
-    111: 5, 112: 4, 113: 5, 114: 6
-}
+from generator import (
+    setup_logging, VERSE_COUNTS, SURAH_NAMES, RECITERS_MAP, BACKGROUND_MODES, OUTPUT_FORMATS, MAX_AYAH_GAP,
+    CancelToken,
+    resolve_ayah_range, output_variants, live_output_path, remove_live_output, profile_summary
+)
+from workers import WorkerPool
+from jobstore import (
+    StoreDispatcher, SQLiteJobStore, open_job_store, QUEUED, RUNNING, DONE, FAILED, CANCELLED,
+    FINISHED_STATES
+)
+from storage import StorageManager
+from serving import send_video
+
+# --- Step: Render Workers ---
+# Generations run in warm worker processes that keep moviepy, fonts and the
+# background list loaded; each worker is recycled after WORKER_MAX_JOBS jobs.
+# With QURAN_REELS_JOB_STORE set (e.g. sqlite:///var/lib/quran-reels/jobs.sqlite),
+# jobs are queued in that store instead and rendered by `python workers.py --store ...`
+# processes; a SQLite store is local to this host (see jobstore.py).
+RENDER_WORKERS = int(os.environ.get("QURAN_REELS_WORKERS", "1"))
+WORKER_MAX_JOBS = int(os.environ.get("QURAN_REELS_WORKER_MAX_JOBS", "20"))
+JOB_STORE = os.environ.get("QURAN_REELS_JOB_STORE")
+
+# --- Step: Job History ---
+# Every job (inputs, status, stage timings, output, error, log) is kept in the
+# job store. Jobs this server was rendering locally when it stopped are marked
+# failed on startup, or requeued and resumed with QURAN_REELS_REQUEUE_INTERRUPTED=1.
+SERVER_WORKER = f"server:{socket.gethostname()}"
+REQUEUE_INTERRUPTED = os.environ.get("QURAN_REELS_REQUEUE_INTERRUPTED", "0") == "1"
+
+# --- Step: Output Retention ---
+# Videos are evicted least-recently-served first once outputs/video exceeds
+# the byte quota, or when unused for longer than the max age (0 disables each).
+MAX_VIDEO_BYTES = int(os.environ.get("QURAN_REELS_MAX_VIDEO_BYTES", "0"))
+MAX_VIDEO_AGE_DAYS = float(os.environ.get("QURAN_REELS_MAX_VIDEO_AGE_DAYS", "0"))
+STORAGE_INTERVAL = int(os.environ.get("QURAN_REELS_STORAGE_INTERVAL", "3600"))
+
+# Created by init_server(); render workers are spawned processes that import
+# this module as __mp_main__ and must not repeat the server's setup
+job_store = None
+render_pool = None
+storage = None
+
+def init_server():
+    """Configure logging, folders, the portable ffmpeg, the job store, render workers and retention"""
+    global job_store, render_pool, storage
+    
+    # --- Step: Setup Logging ---
+    # Configured once for the process: rotating runlog.txt plus console, written by
+    # a background thread; render workers forward their records here.
+    setup_logging(EXEC_DIR)
+    
+    logging.info("--- Starting Quran Reels Generator ---")
+    logging.info(f"Execution Directory: {EXEC_DIR}")
+    logging.info(f"Bundled Directory: {BUNDLE_DIR}")
+    
+    # Create folders on startup
+    try:
+        os.makedirs(AUDIO_DIR, exist_ok=True)
+        os.makedirs(VIDEO_DIR, exist_ok=True)
+        os.makedirs(FONT_DIR, exist_ok=True)
+        logging.info("Output and Font directories verified.")
+    except Exception as e:
+        logging.error(f"Failed to create directories: {e}")
+    
+    # Validate Bundled Requirements
+    if not os.path.isfile(FFMPEG_EXE): logging.error(f"Missing ffmpeg.exe at {FFMPEG_EXE}")
+    if not os.path.isdir(VISION_DIR): logging.error(f"Missing vision folder at {VISION_DIR}")
+    if not os.path.isfile(UI_PATH): logging.error(f"Missing UI.html at {UI_PATH}")
+    
+    # --- Step: Configure Environment Variables ---
+    # Render workers inherit these when they are spawned
+    os.environ["FFMPEG_BINARY"] = FFMPEG_EXE
+    os.environ["IMAGEIO_FFMPEG_EXE"] = FFMPEG_EXE
+    
+    # Prepend PATH for DLL discovery
+    os.environ["PATH"] = os.pathsep.join([
+        os.path.dirname(FFMPEG_EXE),
+        os.environ.get("PATH", "")
+    ])
+    
+    logging.info("Environment variables set for portable binaries.")
+    
+    if JOB_STORE:
+        job_store = open_job_store(JOB_STORE)
+        render_pool = StoreDispatcher(job_store)
+        logging.info(f"Dispatching jobs through job store {JOB_STORE}")
+    else:
+        job_store = SQLiteJobStore(os.path.join(OUT_DIR, "jobs.sqlite"))
+        render_pool = WorkerPool(
+            size=RENDER_WORKERS,
+            max_jobs_per_worker=WORKER_MAX_JOBS,
+            app_dir=EXEC_DIR,
+            bundle_dir=BUNDLE_DIR
+        )
+    
+    storage = StorageManager(VIDEO_DIR, max_bytes=MAX_VIDEO_BYTES, max_age_days=MAX_VIDEO_AGE_DAYS)
 
-# Surah names in Arabic
-SURAH_NAMES = [
-    'الفاتحة', 'البقرة', 'آل عمران', 'النساء', 'المائدة', 'الأنعام', 'الأعراف', 'الأنفال', 'التوبة', 'يونس',
-    'هود', 'يوسف', 'الرعد', 'إبراهيم', 'الحجر', 'النحل', 'الإسراء', 'الكهف', 'مريم', 'طه',
-    'الأنبياء', 'الحج', 'المؤمنون', 'النور', 'الفرقان', 'الشعراء', 'النمل', 'القصص', 'العنكبوت', 'الروم',
-    'لقمان', 'السجدة', 'الأحزاب', 'سبأ', 'فاطر', 'يس', 'الصافات', 'ص', 'الزمر', 'غافر',
-    'فصلت', 'الشورى', 'الزخرف', 'الدخان', 'الجاثية', 'الأحقاف', 'محمد', 'الفتح', 'الحجرات', 'ق',
-    'الذاريات', 'الطور', 'النجم', 'القمر', 'الرحمن', 'الواقعة', 'الحديد', 'المجادلة', 'الحشر', 'الممتحنة',
-    'الصف', 'الجمعة', 'المنافقون', 'التغابن', 'الطلاق', 'التحريم', 'الملك', 'القلم', 'الحاقة', 'المعارج',
-    'نوح', 'الجن', 'المزمل', 'المدثر', 'القيامة', 'الإنسان', 'المرسلات', 'النبأ', 'النازعات', 'عبس',
-    'التكوير', 'الانفطار', 'المطففين', 'الانشقاق', 'البروج', 'الطارق', 'الأعلى', 'الغاشية', 'الفجر', 'البلد',
-    'الشمس', 'الليل', 'الضحى', 'الشرح', 'التين', 'العلق', 'القدر', 'البينة', 'الزلزلة', 'العاديات',
-    'القارعة', 'التكاثر', 'العصر', 'الهمزة', 'الفيل', 'قريش', 'الماعون', 'الكوثر', 'الكافرون', 'النصر',
-    'المسد', 'الإخلاص', 'الفلق', 'الناس'
-]
-
-# Reciters mapping
-RECITERS_MAP = {
-    'الشيخ عبدالباسط عبدالصمد': 'AbdulSamad_64kbps_QuranExplorer.Com',
-    'الشيخ عبدالباسط عبدالصمد (مرتل)': 'Abdul_Basit_Murattal_64kbps',
-    'الشيخ عبدالرحمن السديس': 'Abdurrahmaan_As-Sudais_64kbps',
-    'الشيخ ماهر المعيقلي': 'Maher_AlMuaiqly_64kbps',
-    'الشيخ محمد صديق المنشاوي (مجود)': 'Minshawy_Mujawwad_64kbps',
-    'الشيخ سعود الشريم': 'Saood_ash-Shuraym_64kbps',
-    'الشيخ مشاري العفاسي': 'Alafasy_64kbps',
-    'الشيخ محمود خليل الحصري': 'Husary_64kbps',
-    'الشيخ عبدالله الحذيفي': 'Hudhaify_64kbps',
-    'الشيخ أبو بكر الشاطري': 'Abu_Bakr_Ash-Shaatree_128kbps',
-    'الشيخ محمود علي البنا': 'mahmoud_ali_al_banna_32kbps'
-}
+# /outputs/<job_id>/live.mp4 streams fragments as the encoder appends them
+LIVE_CHUNK_SIZE = 256 * 1024
+LIVE_POLL_INTERVAL = 0.25
 
 # Global progress tracking
 current_progress = {
@@ -170,15 +159,25 @@ current_progress = {
     'is_running': False,
     'is_complete': False,
     'output_path': None,
-    'error': None
+    'outputs': None,
+    'error': None,
+    'job_id': None
 }
 
+# Cancellation for the running job (replaced on every new job)
+current_cancel = CancelToken()
+
+# Inputs of the running job; an identical request joins it instead of starting another
+current_job_key = None
+job_lock = threading.Lock()
+
 # Flask App
 app = Flask(__name__, static_folder=EXEC_DIR) # Not used directly due to custom route
 CORS(app)
 
 def reset_progress():
-    global current_progress
+    global current_progress, current_cancel
+    current_cancel = CancelToken()
     current_progress = {
         'percent': 0,
         'status': 'جاري التحضير...',
@@ -186,126 +185,41 @@ def reset_progress():
         'is_running': False,
         'is_complete': False,
         'output_path': None,
-        'error': None
+        'outputs': None,
+        'error': None,
+        'job_id': None
     }
 
 def add_log(message):
     current_progress['log'].append(message)
     logging.info(f"PROGRESS: {message}")
     print(f'>>> {message}', flush=True)
+    # Store workers write their own log lines to the job store
+    if current_progress['job_id'] and not JOB_STORE:
+        job_store.log(current_progress['job_id'], message)
 
 def update_progress(percent, status):
+    changed = (percent, status) != (current_progress['percent'], current_progress['status'])
     current_progress['percent'] = percent
     current_progress['status'] = status
     logging.info(f"STATUS ({percent}%): {status}")
+    if changed and current_progress['job_id'] and not JOB_STORE:
+        job_store.heartbeat(current_progress['job_id'], SERVER_WORKER, None, percent, status)
 
-def clear_outputs():
-    # Only clear audio directory to keep video history
-    if os.path.isdir(AUDIO_DIR):
-        try:
-            shutil.rmtree(AUDIO_DIR)
-            os.makedirs(AUDIO_DIR, exist_ok=True)
-        except Exception as e:
-            logging.error(f"Error clearing audio output: {e}")
-    
-def detect_leading_silence(sound, thresh, chunk=10):
-    t = 0
-    while t < len(sound) and sound[t:t + chunk].dBFS < thresh:
-        t += chunk
-    return t
-
-def detect_trailing_silence(sound, thresh, chunk=10):
-    return detect_leading_silence(sound.reverse(), thresh, chunk)
-
-def download_audio(reciter_id, surah, ayah, idx):
-    os.makedirs(AUDIO_DIR, exist_ok=True)
-    fn = f'{surah:03d}{ayah:03d}.mp3'
-    url = f'https://everyayah.com/data/{reciter_id}/{fn}'
-    out = os.path.join(AUDIO_DIR, f'part{idx}.mp3')
-    r = http_requests.get(url)
-    r.raise_for_status()
-    with open(out, 'wb') as f:
-        f.write(r.content)
-    snd = AudioSegment.from_file(out, 'mp3')
-    start = detect_leading_silence(snd, snd.dBFS - 16)
-    end = detect_trailing_silence(snd, snd.dBFS - 16)
-    trimmed = snd[start:len(snd) - end]
-    trimmed.export(out, format='mp3')
-    return out
-
-def get_ayah_text(surah, ayah):
-    try:
-        resp = http_requests.get(f'https://api.alquran.cloud/v1/ayah/{surah}:{ayah}/quran-uthmani')
-        resp.raise_for_status()
-        return resp.json()['data']['text']
-    except Exception as e:
-        logging.error(f"Failed to fetch ayah text: {e}")
-        raise
-
-def wrap_text(text, per_line):
-    """Wrap text into multiple lines based on word count per line"""
-    words = text.split()
-    lines = [' '.join(words[i:i + per_line]) for i in range(0, len(words), per_line)]
-    return '\n'.join(lines)
-
-def create_text_clip(arabic, duration, video_height=1080):
-    """
-    Create text clip for Arabic only.
-    Dynamically adjusts font size and wrapping based on text length to ensure
-    it looks organized and fits the screen beautifully.
+def build_video(reciter_id, surah, start_ayah, end_ayah=None, ayah_gap=0.0, seed=None,
+                background_mode='per_ayah', formats=None, live=False, profile=False, deadline=None,
+                job_id=None):
     """
-    words = arabic.split()
-    word_count = len(words)
-    
-    # Dynamic settings based on text length
-    if word_count > 60:
-        fontsize = 16
-        per_line = 10
-    elif word_count > 40:
-        fontsize = 20
-        per_line = 9
-    elif word_count > 25:
-        fontsize = 25
-        per_line = 8
-    elif word_count > 15:
-        fontsize = 30
-        per_line = 7
-    else:
-        fontsize = 35
-        per_line = 6
-        
-    wrapped_text = wrap_text(arabic, per_line)
-    
-    # Create the text clip centered on screen
-    # Use TextClip with the correct bundled font path
-    ar_clip = TextClip(
-        wrapped_text, 
-        font=FONT_PATH_ARABIC, 
-        fontsize=fontsize, 
-        color='white', 
-        method='caption', 
-        size=(900, None), # Allow height to expand as needed, constrain width
-        align='center',
-    ).set_duration(duration).set_position('center')
-    
-    return ar_clip
-
-
-def pick_bg():
-    try:
-        files = [f for f in os.listdir(VISION_DIR) if f.startswith('nature_part') and f.endswith('.mp4')]
-        if not files: 
-            logging.error("No bg videos found in vision folder!")
-            raise ValueError("No background videos found.")
-        return os.path.join(VISION_DIR, random.choice(files))
-    except Exception as e:
-        logging.error(f"Error picking background: {e}")
-        raise
-
-def build_video(reciter_id, surah, start_ayah, end_ayah=None):
-    """
-    Build video from start_ayah to end_ayah.
+    Build video from start_ayah to end_ayah on a warm render worker (local or via the job store).
     If end_ayah is None, it defaults to start_ayah + 9 or max ayah of surah.
+    ayah_gap inserts optional silence (seconds) between verses in the mixed audio.
+    seed fixes the background choice; identical jobs return the existing video.
+    background_mode 'continuous' decodes one background under the whole reel.
+    formats lists OUTPUT_FORMATS keys to encode from the same composition (first one is output_path).
+    live writes fragmented MP4 that /outputs/<job_id>/live.mp4 streams while it encodes.
+    profile runs the job under cProfile; the stats are served at /api/jobs/<job_id>/profile.
+    deadline (seconds) fails the job with a stage-attributed error once a stage overruns its budget.
+    job_id resumes a job already recorded in the job store (requeued on startup).
     """
     global current_progress
     try:
@@ -313,69 +227,58 @@ def build_video(reciter_id, surah, start_ayah, end_ayah=None):
         current_progress['is_complete'] = False
         current_progress['error'] = None
         
-        add_log('[1] Clearing output folders...')
-        update_progress(5, 'جاري تنظيف ملفات الإخراج...')
-        clear_outputs()
-        
-        max_ayah = VERSE_COUNTS[surah]
-        # Use end_ayah if provided, otherwise default to start_ayah + 9
-        if end_ayah is None:
-            last_ayah = min(start_ayah + 9, max_ayah)
+        job = {
+            'reciter_id': reciter_id,
+            'surah': surah,
+            'start_ayah': start_ayah,
+            'end_ayah': end_ayah,
+            'ayah_gap': ayah_gap,
+            'seed': seed,
+            'background_mode': background_mode
+        }
+        if formats:
+            job['formats'] = formats
+        if live:
+            job['live'] = True
+        if profile:
+            job['profile'] = True
+        if deadline:
+            job['deadline'] = deadline
+        if JOB_STORE:
+            job_id = job_id or job_store.submit(job)
+            current_progress['job_id'] = job_id
+            success, out, error = render_pool.wait(
+                job_id,
+                progress_callback=update_progress,
+                log_callback=add_log,
+                cancel=current_cancel
+            )
         else:
-            last_ayah = min(end_ayah, max_ayah)
+            job_id = job_id or job_store.submit(job, worker_id=SERVER_WORKER)
+            current_progress['job_id'] = job_id
+            if job.pop('live', False):
+                job['live_id'] = job_id
+            success, out, error = render_pool.run(
+                job,
+                progress_callback=update_progress,
+                log_callback=add_log,
+                cancel=current_cancel,
+                stage_callback=lambda name, seconds: job_store.record_stage(job_id, name, seconds),
+                profile_callback=lambda path: job_store.record_profile(job_id, path)
+            )
+            if success:
+                status = DONE
+            else:
+                status = CANCELLED if current_cancel.cancelled else FAILED
+            job_store.finish(job_id, SERVER_WORKER, status, out, error)
         
-        # Ensure last_ayah is not less than start_ayah
-        if last_ayah < start_ayah:
-            last_ayah = start_ayah
-        
-        total = last_ayah - start_ayah + 1
-        
-        add_log(f'[2] Preparing {total} آيات (from {start_ayah} to {last_ayah})')
-        update_progress(10, f'جاري تحضير {total} آيات...')
-        
-        clips = []
-        for idx, ayah in enumerate(range(start_ayah, last_ayah + 1), start=1):
-            progress_per_ayah = 70 / total
-            base_progress = 10 + (idx - 1) * progress_per_ayah
-            
-            add_log(f'[3.{idx}] Downloading audio for آية {ayah}')
-            update_progress(int(base_progress + progress_per_ayah * 0.3), f'جاري تحميل صوت الآية {ayah}...')
-            ap = download_audio(reciter_id, surah, ayah, idx - 1)
-            
-            add_log(f'[3.{idx}] Fetching texts')
-            update_progress(int(base_progress + progress_per_ayah * 0.5), f'جاري جلب نص الآية {ayah}...')
-            ar = get_ayah_text(surah, ayah)
-            
-            dur = AudioFileClip(ap).duration
-            audio = AudioFileClip(ap).audio_fadein(0.2).audio_fadeout(0.2)
-            
-            add_log(f'[3.{idx}] Building segment')
-            update_progress(int(base_progress + progress_per_ayah * 0.8), f'جاري إنشاء مقطع الآية {ayah}...')
-            bg = VideoFileClip(pick_bg())
-            seg_bg = bg.fx(vfx.loop, duration=dur).subclip(0, dur)
-            ar_clip = create_text_clip(ar, dur)
-            
-            seg = CompositeVideoClip([seg_bg, ar_clip]).set_audio(audio)
-            clips.append(seg)
-        
-        add_log('[4] Concatenating segments...')
-        update_progress(85, 'جاري دمج المقاطع...')
-        final = concatenate_videoclips(clips, method='compose')
-        
-        # Generate a unique filename
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        surah_name = SURAH_NAMES[surah-1]
-        filename = f"QuranReel_{surah_name}_{start_ayah}-{last_ayah}_{timestamp}.mp4"
-        out = os.path.join(VIDEO_DIR, filename)
-        
-        add_log(f'[5] Writing final video → {out}')
-        update_progress(90, 'جاري كتابة الفيديو النهائي...')
-        final.write_videofile(out, fps=24, codec='libx264', audio_codec='aac', audio_bitrate='192k', verbose=False, ffmpeg_params=['-movflags', '+faststart'])
-        
-        add_log('[6] Done!')
-        update_progress(100, 'تم بنجاح!')
-        current_progress['is_complete'] = True
-        current_progress['output_path'] = out
+        if success:
+            current_progress['is_complete'] = True
+            current_progress['output_path'] = out
+            if formats:
+                current_progress['outputs'] = output_variants(out, formats)
+        else:
+            current_progress['error'] = error
         
     except Exception as e:
         logger_error_msg = f"Error in build_video: {str(e)}\n{traceback.format_exc()}"
@@ -383,9 +286,42 @@ def build_video(reciter_id, surah, start_ayah, end_ayah=None):
         current_progress['error'] = str(e)
         add_log(f'[ERROR] {str(e)}')
         update_progress(0, f'خطأ: {str(e)}')
+        if current_progress['job_id'] and not JOB_STORE:
+            job_store.finish(current_progress['job_id'], SERVER_WORKER, FAILED, None, str(e))
     finally:
         current_progress['is_running'] = False
 
+def recover_jobs():
+    """Fail or requeue jobs a previous run of this server left unfinished, then resume requeued ones"""
+    if JOB_STORE:
+        # Store workers own their jobs; expired leases are retried by the store
+        return
+    interrupted = job_store.recover(SERVER_WORKER, requeue=REQUEUE_INTERRUPTED)
+    if interrupted:
+        action = 'Requeued' if REQUEUE_INTERRUPTED else 'Marked failed'
+        logging.info(f"{action} {len(interrupted)} interrupted job(s)")
+    
+    # Live files whose readers outlived the job (see publish_live_output)
+    live_dir = os.path.join(OUT_DIR, 'live')
+    for name in os.listdir(live_dir) if os.path.isdir(live_dir) else []:
+        job = job_store.get(os.path.splitext(name)[0])
+        if job is None or job['status'] not in (QUEUED, RUNNING):
+            remove_live_output(os.path.join(live_dir, name))
+    
+    global current_job_key
+    while True:
+        with job_lock:
+            if current_progress['is_running']:
+                return
+            job = job_store.lease(SERVER_WORKER, None)
+            if job is None:
+                return
+            reset_progress()
+            current_progress['is_running'] = True
+            current_job_key = None
+        logging.info(f"Resuming job {job['id']}")
+        build_video(job_id=job['id'], **job['params'])
+
 # API Routes
 @app.route('/')
 def serve_ui():
@@ -397,10 +333,7 @@ def serve_ui():
 
 @app.route('/api/generate', methods=['POST'])
 def generate_video():
-    global current_progress
-    
-    if current_progress['is_running']:
-        return jsonify({'error': 'عملية إنشاء فيديو قيد التنفيذ بالفعل'}), 400
+    global current_progress, current_job_key
     
     data = request.json
     reciter_id = data.get('reciter')
@@ -409,19 +342,118 @@ def generate_video():
     end_ayah = data.get('endAyah')
     if end_ayah is not None:
         end_ayah = int(end_ayah)
+    try:
+        ayah_gap = float(data.get('ayahGap', 0) or 0)
+    except (TypeError, ValueError):
+        ayah_gap = -1
+    if not math.isfinite(ayah_gap) or not 0 <= ayah_gap <= MAX_AYAH_GAP:
+        return jsonify({'error': f'ayahGap must be between 0 and {MAX_AYAH_GAP:g} seconds'}), 400
+    seed = data.get('seed')
+    if seed is not None:
+        seed = int(seed)
+    background_mode = data.get('backgroundMode', 'per_ayah')
+    if background_mode not in BACKGROUND_MODES:
+        return jsonify({'error': f'Unknown background mode: {background_mode}'}), 400
+    formats = data.get('formats') or None
+    if formats is not None:
+        if not isinstance(formats, list) or len(set(formats)) != len(formats):
+            return jsonify({'error': 'formats must be a list of distinct output formats'}), 400
+        unknown = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+        if unknown:
+            return jsonify({'error': f'Unknown output format: {unknown[0]}'}), 400
+    live = bool(data.get('live', False))
+    profile = bool(data.get('profile', False))
+    deadline = data.get('deadline')
+    if deadline is not None:
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            deadline = -1
+        if deadline <= 0:
+            return jsonify({'error': 'deadline must be a positive number of seconds'}), 400
     
-    reset_progress()
+    job_key = (reciter_id, surah, start_ayah, resolve_ayah_range(surah, start_ayah, end_ayah), ayah_gap, seed,
+               background_mode, tuple(formats or ()), live, profile, deadline)
+    
+    with job_lock:
+        if current_progress['is_running']:
+            if job_key == current_job_key:
+                # Same request already rendering: follow its progress instead of rendering twice
+                return jsonify({'success': True, 'message': 'بدأ إنشاء الفيديو', 'coalesced': True})
+            return jsonify({'error': 'عملية إنشاء فيديو قيد التنفيذ بالفعل'}), 400
+        
+        reset_progress()
+        current_progress['is_running'] = True
+        current_job_key = job_key
     
     # Start video generation in background thread
-    thread = threading.Thread(target=build_video, args=(reciter_id, surah, start_ayah, end_ayah), daemon=True)
+    thread = threading.Thread(target=build_video, args=(reciter_id, surah, start_ayah, end_ayah, ayah_gap, seed, background_mode, formats, live, profile, deadline), daemon=True)
     thread.start()
     
     return jsonify({'success': True, 'message': 'بدأ إنشاء الفيديو'})
 
+@app.route('/api/cancel', methods=['POST'])
+def cancel_video():
+    if not current_progress['is_running']:
+        return jsonify({'error': 'لا توجد عملية قيد التنفيذ'}), 400
+    
+    # The worker aborts in-flight downloads, kills the encoder and cleans up partial files
+    current_cancel.cancel()
+    add_log('Cancelling...')
+    return jsonify({'success': True, 'message': 'جاري إلغاء العملية'})
+
 @app.route('/api/progress', methods=['GET'])
 def get_progress():
     return jsonify(current_progress)
 
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    # Job history, newest first: ?page=1&per_page=20&status=done
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(100, max(1, request.args.get('per_page', 20, type=int)))
+    status = request.args.get('status')
+    jobs, total = job_store.list_jobs((page - 1) * per_page, per_page, status)
+    return jsonify({
+        'jobs': jobs,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': (total + per_page - 1) // per_page
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['log'] = [message for _, message in job_store.logs(job_id)]
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/profile', methods=['GET'])
+def get_job_profile(job_id):
+    """cProfile stats of a profiled job (?format=text for a cumulative-time summary)"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] not in FINISHED_STATES:
+        return jsonify({'error': f"No profile for a job that is {job['status']}"}), 404
+    # Failed and timed-out jobs keep their profile too (saved in outputs/profiles)
+    path = job['profile_path']
+    if not path:
+        return jsonify({'error': 'Job was not profiled'}), 404
+    if not os.path.isfile(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    if request.args.get('format') == 'text':
+        return Response(profile_summary(path), mimetype='text/plain')
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{job_id}.prof')
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    # Adaptive per-host download concurrency, as last reported by each render worker,
+    # and each running job's share of the CPU budget
+    return jsonify({'upstream': render_pool.upstream_metrics(), 'cpu': render_pool.cpu_metrics()})
+
 @app.route('/api/config', methods=['GET'])
 def get_config():
     return jsonify({
@@ -430,15 +462,109 @@ def get_config():
         'reciters': RECITERS_MAP
     })
 
+@app.route('/api/storage', methods=['GET'])
+def get_storage():
+    # Dry-run report of what the retention policy would delete now
+    return jsonify(storage.enforce(dry_run=True))
+
+@app.route('/api/storage/cleanup', methods=['POST'])
+def cleanup_storage():
+    return jsonify(storage.enforce())
+
+@app.route('/outputs/<job_id>/live.mp4')
+def serve_live_video(job_id):
+    """Stream a live job's fragmented MP4 as it is written, or the finished video"""
+    def finished_output(job):
+        if job['status'] == DONE and job['output_path'] and os.path.isfile(job['output_path']):
+            return job['output_path']
+        return None
+    
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if finished_output(job):
+        return send_video(request, finished_output(job), immutable=True)
+    
+    live_path = live_output_path(OUT_DIR, job_id)
+    try:
+        live_file = open(live_path, 'rb')
+    except FileNotFoundError:
+        # The job may have finished and moved its live file meanwhile
+        job = job_store.get(job_id)
+        if finished_output(job):
+            return send_video(request, finished_output(job), immutable=True)
+        if job['status'] in (QUEUED, RUNNING):
+            # Encoding has not started yet; players retry
+            return jsonify({'error': 'Live output not started yet', 'percent': job['progress']}), 404
+        return jsonify({'error': job['error'] or 'No live output for this job'}), 404
+    
+    def stream():
+        # Tail the file until the job finishes. On POSIX the handle survives the
+        # final move; on Windows it blocks it, and the job copies the file instead.
+        try:
+            with live_file:
+                while True:
+                    chunk = live_file.read(LIVE_CHUNK_SIZE)
+                    if chunk:
+                        yield chunk
+                    elif job_store.get(job_id)['status'] in (QUEUED, RUNNING):
+                        time.sleep(LIVE_POLL_INTERVAL)
+                    else:
+                        rest = live_file.read()
+                        if rest:
+                            yield rest
+                        return
+        finally:
+            # The last reader out removes a live file the job could not move
+            if job_store.get(job_id)['status'] not in (QUEUED, RUNNING):
+                remove_live_output(live_path)
+    
+    return Response(stream(), mimetype='video/mp4', headers={'Cache-Control': 'no-store'})
+
 @app.route('/outputs/<path:filename>')
 def serve_output(filename):
-    return send_from_directory(OUT_DIR, filename)
+    path = safe_join(OUT_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    # Reel names carry the job fingerprint, so a name always means the same bytes
+    is_video = os.path.dirname(filename) == 'video'
+    response = send_video(request, path, immutable=is_video)
+    if is_video:
+        storage.touch(filename)
+    return response
 
 @app.route('/final_video.mp4')
 def serve_final_video():
-    return send_from_directory(EXEC_DIR, 'final_video.mp4')
+    path = os.path.join(EXEC_DIR, 'final_video.mp4')
+    if not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    return send_video(request, path)
+
+def create_app():
+    """
+    Set the server up and start its background work; returns the Flask app.
+    Also the entry point for serving with gunicorn on Linux, where video Range
+    requests are sent with sendfile (see serving.py). Job progress lives in this
+    process, so run a single worker:
+        gunicorn -w 1 --threads 16 -b 127.0.0.1:5000 'main:create_app()'
+    """
+    init_server()
+    
+    # Start warm render workers before the first request arrives
+    render_pool.start()
+    
+    # Settle jobs interrupted by the last shutdown (resumes requeued ones in the background)
+    threading.Thread(target=recover_jobs, daemon=True).start()
+    
+    # Periodic retention enforcement for outputs/video; last-served times are
+    # saved every minute and on exit
+    storage.start_background(STORAGE_INTERVAL)
+    atexit.register(storage.stop)
+    return app
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    create_app()
     logging.info('Server Starting...')
     print('=' * 50)
     print('  One-Click Quran Reels Generator')
@@ -7,30 +7,38 @@ Replaces the Flask+HTML interface with a mobile-native interface.
 import os
 import sys
 import threading
+from collections import deque
 from datetime import datetime
 
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
-from kivy.uix.scrollview import ScrollView
 from kivy.uix.label import Label
 from kivy.uix.button import Button
+from kivy.uix.checkbox import CheckBox
 from kivy.uix.spinner import Spinner
 from kivy.uix.textinput import TextInput
 from kivy.uix.progressbar import ProgressBar
 from kivy.uix.popup import Popup
-from kivy.uix.filechooser import FileChooserListView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.metrics import dp
 from kivy.properties import StringProperty, NumericProperty, ListProperty, BooleanProperty
 from kivy.clock import Clock
 from kivy.core.window import Window
 from kivy.graphics import Color, Rectangle, RoundedRectangle
 from kivy.utils import platform
 
-# Import our generator module
+# Import our generator module (cheap: moviepy/pydub/requests are loaded lazily)
 from generator import (
     VideoGenerator, RECITERS_MAP, SURAH_NAMES, 
-    VERSE_COUNTS, get_app_dir, get_bundle_dir
+    VERSE_COUNTS, MEMORY_BUDGET_MB, get_app_dir, get_bundle_dir, warm_up_media
 )
+from memory import physical_memory, MB
+
+# Share of the phone's RAM a generation may use before it fails with a clear
+# error (and degrades before that) instead of being killed by Android
+ANDROID_MEMORY_FRACTION = 0.4
 
 # Colors matching original UI theme
 COLORS = {
@@ -151,41 +159,111 @@ class NumberInput(BoxLayout):
             self.text_input.text = str(self.value)
 
 
-class LogConsole(ScrollView):
-    """Scrollable log console"""
+class LogLine(Label):
+    """One recycled row of the log console"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.halign = 'left'
+        self.valign = 'middle'
+        self.color = COLORS['text_secondary']
+        self.font_size = '12sp'
+        self.font_name = 'monospace'
+        self.markup = True
+        self.shorten = True
+        self.bind(width=lambda inst, w: setattr(inst, 'text_size', (w, None)))
+
+
+class LogConsole(RecycleView):
+    """
+    Scrollable log console keeping the last MAX_LINES lines in a ring buffer.
+    Only the visible rows are widgets (recycled as the view scrolls), so adding
+    lines costs the same however long the log gets.
+    """
+    
+    MAX_LINES = 500
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.size_hint_y = None
         self.height = '150dp'
+        self.viewclass = LogLine
         
-        self.log_label = Label(
-            text='',
+        layout = RecycleBoxLayout(
+            orientation='vertical',
             size_hint_y=None,
-            halign='left',
-            valign='top',
-            color=COLORS['text_secondary'],
-            font_size='12sp',
-            font_name='monospace',
-            markup=True
+            default_size=(None, dp(18)),
+            default_size_hint=(1, None)
         )
-        self.log_label.bind(texture_size=self.log_label.setter('size'))
-        self.add_widget(self.log_label)
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.lines = deque(maxlen=self.MAX_LINES)
         
-    def add_log(self, message, log_type='info'):
+    @staticmethod
+    def format_line(message, log_type='info'):
         color = {
             'info': 'd4af37',
             'success': '4ade80',
             'error': 'f87171'
         }.get(log_type, 'd4af37')
-        
         timestamp = datetime.now().strftime('%H:%M:%S')
-        log_line = f"[color={color}][{timestamp}] {message}[/color]\n"
-        
-        current_text = self.log_label.text
-        self.log_label.text = current_text + log_line
+        return f"[color={color}][{timestamp}] {message}[/color]"
         
+    def add_lines(self, lines):
+        """Append formatted lines (one refresh for the whole batch)"""
+        self.lines.extend(lines)
+        self.data = [{'text': line} for line in self.lines]
         # Auto-scroll to bottom
         self.scroll_y = 0
+        
+    def add_log(self, message, log_type='info'):
+        self.add_lines([self.format_line(message, log_type)])
+        
+    def clear(self):
+        self.lines.clear()
+        self.data = []
+
+
+class UIUpdateChannel:
+    """
+    Collects progress and log events from the generator thread and applies
+    them on the UI thread at most once per frame: progress keeps only the
+    latest value, log lines are applied as one batch.
+    """
+    
+    def __init__(self, on_progress, on_logs):
+        self.on_progress = on_progress
+        self.on_logs = on_logs
+        self._lock = threading.Lock()
+        self._progress = None
+        self._logs = []
+        self._scheduled = False
+        self._trigger = Clock.create_trigger(self._flush)
+        
+    def _schedule(self):
+        # Called with the lock held; one pending trigger per frame
+        if not self._scheduled:
+            self._scheduled = True
+            self._trigger()
+        
+    def post_progress(self, percent, status):
+        with self._lock:
+            self._progress = (percent, status)
+            self._schedule()
+            
+    def post_log(self, message):
+        with self._lock:
+            self._logs.append(message)
+            self._schedule()
+            
+    def _flush(self, dt):
+        with self._lock:
+            progress, self._progress = self._progress, None
+            logs, self._logs = self._logs, []
+            self._scheduled = False
+        if logs:
+            self.on_logs(logs)
+        if progress is not None:
+            self.on_progress(*progress)
 
 
 class MainLayout(BoxLayout):
@@ -214,8 +292,8 @@ class MainLayout(BoxLayout):
         # Bind surah change to update ayah limits
         self.surah_spinner.bind(text=self.on_surah_change)
         
-        # Setup periodic progress check
-        Clock.schedule_interval(self.check_progress, 0.1)
+        # Generator events reach the widgets through one per-frame update
+        self.ui_updates = UIUpdateChannel(self.update_progress_ui, self.add_log_messages)
         
     def build_header(self):
         """Build app header with logo"""
@@ -318,6 +396,17 @@ class MainLayout(BoxLayout):
         self.end_ayah_input.text_input.text = '7'
         form_card.add_widget(self.end_ayah_input)
         
+        # Debug: profile the next generation (stats saved next to the video)
+        profile_row = BoxLayout(size_hint_y=None, height='40dp')
+        profile_row.add_widget(Label(
+            text='تسجيل ملف الأداء (للتصحيح)',
+            color=COLORS['text_secondary'],
+            halign='right'
+        ))
+        self.profile_checkbox = CheckBox(size_hint_x=None, width='40dp')
+        profile_row.add_widget(self.profile_checkbox)
+        form_card.add_widget(profile_row)
+        
         # Generate button
         self.generate_btn = StyledButton(
             text='إنشاء الفيديو',
@@ -456,26 +545,35 @@ class MainLayout(BoxLayout):
         self.progress_section.opacity = 1
         self.progress_bar.value = 0
         self.progress_percent.text = '0%'
-        self.log_console.log_label.text = ''
+        self.log_console.clear()
         
         # Create generator
         self.generator = VideoGenerator(
             progress_callback=self.on_progress_update,
-            log_callback=self.on_log_message
+            log_callback=self.on_log_message,
+            memory_budget_mb=self.memory_budget_mb()
         )
         
         # Start generation in thread
         self.generation_thread = threading.Thread(
             target=self.run_generation,
-            args=(reciter_id, surah, start_ayah, end_ayah)
+            args=(reciter_id, surah, start_ayah, end_ayah, self.profile_checkbox.active)
         )
         self.generation_thread.daemon = True
         self.generation_thread.start()
         
-    def run_generation(self, reciter_id, surah, start_ayah, end_ayah):
+    @staticmethod
+    def memory_budget_mb():
+        """Configured budget, or a share of physical memory on Android"""
+        if MEMORY_BUDGET_MB or platform != 'android':
+            return MEMORY_BUDGET_MB
+        total = physical_memory()
+        return int(total * ANDROID_MEMORY_FRACTION / MB) if total else 0
+        
+    def run_generation(self, reciter_id, surah, start_ayah, end_ayah, profile=False):
         """Run video generation in background thread"""
         success, output_path, error = self.generator.generate_video(
-            reciter_id, surah, start_ayah, end_ayah
+            reciter_id, surah, start_ayah, end_ayah, profile=profile
         )
         
         # Schedule UI update on main thread
@@ -485,11 +583,8 @@ class MainLayout(BoxLayout):
         )
         
     def on_progress_update(self, percent, status):
-        """Callback for progress updates"""
-        Clock.schedule_once(
-            lambda dt: self.update_progress_ui(percent, status),
-            0
-        )
+        """Callback for progress updates (generator thread)"""
+        self.ui_updates.post_progress(percent, status)
         
     def update_progress_ui(self, percent, status):
         """Update progress UI on main thread"""
@@ -498,17 +593,23 @@ class MainLayout(BoxLayout):
         self.status_label.text = status
         
     def on_log_message(self, message):
-        """Callback for log messages"""
-        Clock.schedule_once(
-            lambda dt: self.add_log_message(message),
-            0
+        """Callback for log messages (generator thread)"""
+        self.ui_updates.post_log(message)
+        
+    @staticmethod
+    def log_type(message):
+        return 'success' if 'Done' in message or 'تم بنجاح' in message else \
+               'error' if 'ERROR' in message or 'خطأ' in message else 'info'
+        
+    def add_log_messages(self, messages):
+        """Add a batch of log messages to the console"""
+        self.log_console.add_lines(
+            [LogConsole.format_line(message, self.log_type(message)) for message in messages]
         )
         
     def add_log_message(self, message):
         """Add log message to console"""
-        log_type = 'success' if 'Done' in message or 'تم بنجاح' in message else \
-                   'error' if 'ERROR' in message or 'خطأ' in message else 'info'
-        self.log_console.add_log(message, log_type)
+        self.add_log_messages([message])
         
     def on_generation_complete(self, success, output_path, error):
         """Handle generation completion"""
@@ -534,9 +635,10 @@ class MainLayout(BoxLayout):
             self.generator.stop()
             self.add_log_message('جاري إلغاء العملية...')
             
-    def check_progress(self, dt):
-        """Periodic progress check (if needed)"""
-        pass
+    def on_media_ready(self, elapsed):
+        """Callback from the warm-up thread once the media engine is imported"""
+        if elapsed:
+            self.ui_updates.post_log(f'Media engine loaded in {elapsed:.2f}s')
         
     def show_success_popup(self, output_path):
         """Show success popup with output location"""
@@ -623,6 +725,10 @@ class QuranReelsApp(App):
     def build(self):
         self.title = 'Quran Reels Generator'
         return MainLayout()
+    
+    def on_start(self):
+        # Import the media engine in the background once the first frame is shown
+        Clock.schedule_once(lambda dt: warm_up_media(self.root.on_media_ready), 0.5)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+"""
+Quran Reels Generator - Memory Accounting
+Samples the process's resident set size while a job runs (and, optionally,
+Python allocations through tracemalloc), keeps the peak of each pipeline
+stage, and enforces a memory budget so a long range fails with a clear error
+instead of the process being OOM-killed (Android, small containers).
+Only this process is measured; ffmpeg decoders and encoders are separate
+processes with their own memory.
+"""
+
+import os
+import sys
+import threading
+import tracemalloc
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised into a job whose process grew past its memory budget"""
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if it cannot be read"""
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/statm', 'rb') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        import resource
+        # Peak rather than current on other platforms (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except (ImportError, OSError):
+        return None
+
+
+def physical_memory():
+    """Total physical memory in bytes, or None if unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class MemoryMonitor:
+    """
+    Background sampler of one job's memory use.
+    Call stage(name) as the pipeline moves on; end_stage() returns the peaks
+    seen since. When budget_bytes is exceeded, on_exceeded is called once with
+    a MemoryBudgetExceeded naming the stage.
+    """
+
+    def __init__(self, budget_bytes=0, interval=0.2, trace_allocations=False, on_exceeded=None):
+        self.budget = budget_bytes
+        self.interval = interval
+        self.trace_allocations = trace_allocations
+        self.on_exceeded = on_exceeded
+        self.current_stage = 'prepare'
+        self.peaks = {}            # stage -> {'rss_mb': ..., 'python_mb': ...}
+        self.exceeded = None
+
+        self._stage_rss = 0
+        self._started_tracing = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        with self._lock:
+            self._stage_rss = max(self._stage_rss, rss)
+            stage = self.current_stage
+            if not self.budget or rss <= self.budget or self.exceeded is not None:
+                return
+            self.exceeded = MemoryBudgetExceeded(
+                f"Memory budget exceeded during {stage}: {rss / MB:.0f} MB in use, "
+                f"budget {self.budget / MB:.0f} MB"
+            )
+        if self.on_exceeded:
+            self.on_exceeded(self.exceeded)
+
+    def usage(self):
+        """Fraction of the budget in use now (0 without a budget)"""
+        rss = current_rss()
+        if not self.budget or rss is None:
+            return 0.0
+        return rss / self.budget
+
+    def headroom(self):
+        """Bytes left before the budget, or None without a budget"""
+        rss = current_rss()
+        if not self.budget or rss is None:
+            return None
+        return max(0, self.budget - rss)
+
+    def end_stage(self, name, next_stage=None):
+        """Close stage `name` and start measuring `next_stage`; returns the stage's peaks"""
+        self._sample()
+        with self._lock:
+            peak = {'rss_mb': round(self._stage_rss / MB, 1)}
+            self._stage_rss = 0
+            self.current_stage = next_stage or self.current_stage
+        if tracemalloc.is_tracing():
+            peak['python_mb'] = round(tracemalloc.get_traced_memory()[1] / MB, 1)
+            tracemalloc.reset_peak()
+        self.peaks[name] = peak
+        return peak
@@ -0,0 +1,243 @@
+"""
+Quran Reels Generator - Reciter Packs
+A pack holds every ayah MP3 of one reciter (a RECITERS_MAP entry) in a single
+file, so audio can be copied between machines and phones as one file and read
+offline with random access.
+
+Layout:
+    MAGIC (4 bytes) | header length (uint32 LE) | header (UTF-8 JSON) | MP3 data
+The header maps "surah:ayah" to [offset, length, trim_start_ms, trim_end_ms,
+duration_ms], offsets relative to the start of the MP3 data. Trim points are
+the silence detected at build time, so reads skip silence detection.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+
+MAGIC = b'QRPK'
+FORMAT_VERSION = 1
+PACK_SUFFIX = '.qrpack'
+
+
+class PackEntry:
+    """Location and trim points of one ayah inside a pack"""
+
+    __slots__ = ('offset', 'length', 'trim_start', 'trim_end', 'duration')
+
+    def __init__(self, offset, length, trim_start, trim_end, duration):
+        self.offset = offset
+        self.length = length
+        self.trim_start = trim_start
+        self.trim_end = trim_end
+        self.duration = duration
+
+
+class ReciterPack:
+    """Memory-mapped reader for a reciter pack"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:4] != MAGIC:
+                raise ValueError(f"Not a reciter pack: {path}")
+            header_len, = struct.unpack_from('<I', self._map, 4)
+            header = json.loads(self._map[8:8 + header_len].decode('utf-8'))
+        except Exception:
+            self.close()
+            raise
+        if header.get('version') != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported reciter pack version in {path}")
+
+        self.reciter_id = header['reciter_id']
+        self._data_start = 8 + header_len
+        self._entries = {key: PackEntry(*value) for key, value in header['entries'].items()}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def surahs(self):
+        """Sorted surah numbers with at least one ayah in the pack"""
+        return sorted({int(key.split(':')[0]) for key in self._entries})
+
+    def entry(self, surah, ayah):
+        """Return the PackEntry for an ayah, or None if the pack lacks it"""
+        return self._entries.get(f'{surah}:{ayah}')
+
+    def read(self, surah, ayah):
+        """Return the ayah's original MP3 bytes"""
+        entry = self.entry(surah, ayah)
+        if entry is None:
+            raise KeyError(f"Ayah {surah}:{ayah} not in pack {self.path}")
+        start = self._data_start + entry.offset
+        return self._map[start:start + entry.length]
+
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+
+    # A pack replaced in its library may still be read by other fetch threads;
+    # it is closed once the last of them drops it
+    __del__ = close
+
+
+class PackLibrary:
+    """
+    Opens packs from a folder on demand, one per reciter id.
+    A pack whose file changes is reopened; the old reader is not closed here,
+    since fetch threads of a running job may still be reading it.
+    """
+
+    def __init__(self, packs_dir):
+        self.packs_dir = packs_dir
+        self._packs = {}
+        self._lock = threading.Lock()
+
+    def pack_path(self, reciter_id):
+        return os.path.join(self.packs_dir, reciter_id + PACK_SUFFIX)
+
+    def get(self, reciter_id):
+        """Return the ReciterPack for reciter_id, or None if no pack is installed"""
+        path = self.pack_path(reciter_id)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._packs.get(reciter_id)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            try:
+                pack = ReciterPack(path)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to open reciter pack {path}: {e}")
+                self._packs.pop(reciter_id, None)
+                return None
+            self._packs[reciter_id] = (mtime, pack)
+            logging.info(f"Opened reciter pack {path} ({len(pack)} ayahs)")
+            return pack
+
+    def close(self):
+        """Close every open pack; only call once no job is reading them"""
+        with self._lock:
+            for _, pack in self._packs.values():
+                pack.close()
+            self._packs.clear()
+
+
+def build_pack(reciter_id, output_path, source_dir=None, surahs=None, log=print):
+    """
+    Build a pack for reciter_id from MP3s named SSSAAA.mp3 in source_dir, or
+    by downloading from everyayah.com when source_dir is None.
+    surahs: optional iterable of surah numbers (default: the whole Quran)
+    Returns: number of ayahs packed
+    """
+    from generator import VERSE_COUNTS, load_media_modules, http_get, find_trim_points
+    load_media_modules()
+    from generator import AudioSegment
+    from io import BytesIO
+
+    entries = {}
+    offset = 0
+    out_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(out_dir, exist_ok=True)
+
+    with tempfile.TemporaryFile(dir=out_dir) as data:
+        for surah in (surahs or range(1, 115)):
+            for ayah in range(1, VERSE_COUNTS[surah] + 1):
+                fn = f'{surah:03d}{ayah:03d}.mp3'
+                if source_dir:
+                    path = os.path.join(source_dir, fn)
+                    if not os.path.exists(path):
+                        log(f"Skipping missing {path}")
+                        continue
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                else:
+                    content = http_get(f'https://everyayah.com/data/{reciter_id}/{fn}', timeout=30)
+
+                sound = AudioSegment.from_file(BytesIO(content), 'mp3')
+                trim_start, trim_end = find_trim_points(sound)
+                duration = max(0, len(sound) - trim_start - trim_end)
+                entries[f'{surah}:{ayah}'] = [offset, len(content), trim_start, trim_end, duration]
+                data.write(content)
+                offset += len(content)
+            log(f"Packed surah {surah} ({len(entries)} ayahs so far)")
+
+        header = json.dumps({
+            'version': FORMAT_VERSION,
+            'reciter_id': reciter_id,
+            'entries': entries
+        }, separators=(',', ':')).encode('utf-8')
+
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header)))
+            out.write(header)
+            data.seek(0)
+            while True:
+                chunk = data.read(1024 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.replace(tmp_path, output_path)
+
+    return len(entries)
+
+
+def parse_surahs(spec):
+    """Parse a surah list like '1-3,36,67' into sorted surah numbers"""
+    surahs = set()
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            surahs.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            surahs.add(int(part))
+    return sorted(s for s in surahs if 1 <= s <= 114)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from generator import RECITERS_MAP, get_app_dir
+
+    parser = argparse.ArgumentParser(description='Build or inspect offline reciter packs')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='Create a pack for one reciter')
+    build.add_argument('reciter', help='Reciter id or name from RECITERS_MAP')
+    build.add_argument('--source', help='Folder of SSSAAA.mp3 files (default: download)')
+    build.add_argument('--surahs', help="Surahs to include, e.g. '1-3,36' (default: all)")
+    build.add_argument('--out', default=os.path.join(get_app_dir(), 'packs'),
+                       help='Folder to write the pack to')
+
+    info = commands.add_parser('info', help='Show what a pack contains')
+    info.add_argument('pack')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        reciter_id = RECITERS_MAP.get(args.reciter, args.reciter)
+        output_path = os.path.join(args.out, reciter_id + PACK_SUFFIX)
+        count = build_pack(reciter_id, output_path, args.source,
+                           parse_surahs(args.surahs) if args.surahs else None)
+        print(f"Wrote {count} ayahs to {output_path}")
+    else:
+        pack = ReciterPack(args.pack)
+        print(f"{pack.reciter_id}: {len(pack)} ayahs, {len(pack.surahs())} surahs, "
+              f"{os.path.getsize(args.pack)} bytes")
+        pack.close()
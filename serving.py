@@ -0,0 +1,190 @@
+"""
+Quran Reels Generator - Video File Serving
+Byte-range responses for rendered videos, as issued by mobile players that
+fetch a reel in many small Range requests. Responses carry a strong ETag and
+Last-Modified so players revalidate with a 304, and fingerprinted outputs are
+marked immutable.
+Every range is handed to the WSGI server's wsgi.file_wrapper when it has one,
+with the file positioned at the range start and Content-Length set to the
+range length. gunicorn sends exactly that slice with sendfile (zero-copy),
+and PEP 3333 servers never send past Content-Length. Flask's built-in server
+(app.run, the portable desktop mode) has no file_wrapper, so there ranges are
+streamed in CHUNK_SIZE reads; see main.create_app for the gunicorn deployment.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import logging
+import argparse
+import mimetypes
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response
+from werkzeug.http import http_date, parse_range_header, parse_etags
+
+CHUNK_SIZE = 256 * 1024
+
+# Fingerprinted reels never change under the same name
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+
+def file_etag(st):
+    """Strong ETag from a file's size and modification time"""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+class FileRange:
+    """Iterates bytes [start, start + length) of an open file in CHUNK_SIZE reads"""
+
+    def __init__(self, f, start, length, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.start = start
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        self.f.seek(self.start)
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.f.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.f.close()
+
+
+def send_video(request, path, immutable=False):
+    """
+    Serve a file with Range, If-Range and If-None-Match support.
+    immutable: the file never changes under this name (long-lived cache headers)
+    Returns: a Flask Response (200, 206, 304 or 416)
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = file_etag(st)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE
+    }
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and parse_etags(if_none_match).contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    ranges = parse_range_header(request.headers.get('Range'))
+    if_range = request.headers.get('If-Range')
+    # A stale If-Range (or a weak/date validator) means "send the whole file";
+    # ranges in units other than bytes are ignored
+    if ranges is not None and ranges.units == 'bytes' and (not if_range or if_range == etag):
+        bounds = ranges.range_for_length(size)
+        if bounds is not None:
+            start, stop = bounds
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        elif len(ranges.ranges) == 1 and ranges.ranges[0][1] is not None:
+            # Only a bounded range that starts past the end is unsatisfiable
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        # A suffix longer than the file (bytes=-N), an open range past the end
+        # (bytes=N-) and multipart ranges, which are not worth supporting for
+        # video, ignore Range and get the whole file
+
+    length = stop - start
+    f = open(path, 'rb')
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    if wrapper is not None:
+        # The server sends Content-Length bytes from the current offset, zero-copy where it can
+        f.seek(start)
+        body = wrapper(f, CHUNK_SIZE)
+    else:
+        body = FileRange(f, start, length)
+
+    response = Response(body, status=status, headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = length
+    return response
+
+
+def _fetch_ranges(host, port, url, size, range_size, count, rng):
+    """Issue count random Range requests; returns per-request latencies in seconds"""
+    latencies = []
+    for _ in range(count):
+        start = rng.randrange(0, max(1, size - range_size))
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        try:
+            conn.request('GET', url, headers={'Range': f'bytes={start}-{start + range_size - 1}'})
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 206 or len(body) != min(range_size, size - start):
+                raise RuntimeError(f'Unexpected response {response.status} ({len(body)} bytes)')
+        finally:
+            conn.close()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def benchmark(path, clients=16, requests_per_client=50, range_size=64 * 1024):
+    """
+    Compare send_video with Flask's send_file under concurrent random Range
+    requests on the threaded development server.
+    Returns: {'send_video': stats, 'send_file': stats}
+    """
+    from flask import Flask, request, send_file
+    from werkzeug.serving import make_server
+
+    app = Flask(__name__)
+    app.add_url_rule('/send_video', 'send_video', lambda: send_video(request, path, immutable=True))
+    app.add_url_rule('/send_file', 'send_file', lambda: send_file(path, conditional=True))
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    size = os.path.getsize(path)
+    results = {}
+    try:
+        for url in ('/send_file', '/send_video'):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                runs = [pool.submit(_fetch_ranges, '127.0.0.1', server.port, url, size,
+                                    range_size, requests_per_client, random.Random(i))
+                        for i in range(clients)]
+                latencies = sorted(t for run in runs for t in run.result())
+            elapsed = time.perf_counter() - started
+            results[url.strip('/')] = {
+                'requests': len(latencies),
+                'requests_per_second': round(len(latencies) / elapsed, 1),
+                'mb_per_second': round(len(latencies) * range_size / elapsed / 1e6, 1),
+                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+                'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2)
+            }
+    finally:
+        server.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark concurrent Range requests against a video')
+    parser.add_argument('video')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=50, help='Requests per client')
+    parser.add_argument('--range-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    json.dump(benchmark(args.video, args.clients, args.requests, args.range_size),
+              sys.stdout, indent=2)
+    print()
@@ -0,0 +1,197 @@
+"""
+Quran Reels Generator - Output Storage Manager
+Keeps outputs/video within a byte quota and maximum age by evicting the
+least recently used reels, where "used" is the last time a video was served
+(or written, if it was never served).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+
+class StorageManager:
+    """Retention policy and disk quota for rendered videos"""
+
+    STATE_FILE = '.served.json'
+    SIDECAR_SUFFIX = '.prof'
+
+    def __init__(self, video_dir, max_bytes=0, max_age_days=0, grace_seconds=600):
+        """
+        max_bytes: total size limit for the folder (0 disables the quota)
+        max_age_days: delete videos unused for this long (0 disables)
+        grace_seconds: never touch files modified this recently (renders in progress)
+        """
+        self.video_dir = video_dir
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.grace_seconds = grace_seconds
+        self.state_path = os.path.join(video_dir, self.STATE_FILE)
+
+        self._lock = threading.Lock()
+        self._last_served = self._load_state()
+        self._dirty = False
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Persist last-served times if they changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            state = dict(self._last_served)
+            self._dirty = False
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def touch(self, filename):
+        """Record that a video was served (filename relative to video_dir)"""
+        with self._lock:
+            self._last_served[os.path.basename(filename)] = time.time()
+            self._dirty = True
+
+    def scan(self):
+        """List videos as dicts with name, size, mtime and last_used"""
+        files = []
+        with self._lock:
+            served = dict(self._last_served)
+        try:
+            entries = list(os.scandir(self.video_dir))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith('.mp4'):
+                continue
+            st = entry.stat()
+            files.append({
+                'name': entry.name,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'last_used': max(st.st_mtime, served.get(entry.name, 0))
+            })
+        return files
+
+    def plan(self, now=None):
+        """
+        Decide what to evict without deleting anything.
+        Returns: report dict with totals and the files to delete (with reasons)
+        """
+        now = now or time.time()
+        files = sorted(self.scan(), key=lambda f: f['last_used'])
+        total = sum(f['size'] for f in files)
+        remaining = total
+        evict = []
+
+        for f in files:
+            if now - f['mtime'] < self.grace_seconds:
+                continue
+            reason = None
+            if self.max_age_days and now - f['last_used'] > self.max_age_days * 86400:
+                reason = 'age'
+            elif self.max_bytes and remaining > self.max_bytes:
+                reason = 'quota'
+            if reason:
+                evict.append({**f, 'reason': reason})
+                remaining -= f['size']
+
+        return {
+            'video_dir': self.video_dir,
+            'files': len(files),
+            'total_bytes': total,
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age_days,
+            'evict': evict,
+            'evict_bytes': total - remaining,
+            'bytes_after': remaining
+        }
+
+    def enforce(self, dry_run=False):
+        """Apply the retention policy; with dry_run only report what would be deleted"""
+        report = self.plan()
+        report['dry_run'] = dry_run
+        if dry_run:
+            return report
+
+        deleted = []
+        for f in report['evict']:
+            try:
+                os.unlink(os.path.join(self.video_dir, f['name']))
+                deleted.append(f['name'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Storage: failed to delete {f['name']}: {e}")
+            # Profiles saved next to a video go with it
+            sidecar = os.path.join(self.video_dir, os.path.splitext(f['name'])[0] + self.SIDECAR_SUFFIX)
+            if os.path.exists(sidecar):
+                try:
+                    os.unlink(sidecar)
+                except OSError:
+                    pass
+
+        with self._lock:
+            for name in deleted:
+                if self._last_served.pop(name, None) is not None:
+                    self._dirty = True
+        self.save()
+
+        report['deleted'] = deleted
+        if deleted:
+            logging.info(f"Storage: evicted {len(deleted)} video(s), freed {report['evict_bytes']} bytes")
+        return report
+
+    def start_background(self, interval=3600, save_interval=60):
+        """
+        Enforce the policy every `interval` seconds in a daemon thread, saving
+        last-served times every `save_interval` seconds in between so a crash or
+        restart loses at most that much of them.
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            next_enforce = time.monotonic() + interval
+            while not self._stop.wait(min(save_interval, max(0.0, next_enforce - time.monotonic()))):
+                try:
+                    if time.monotonic() >= next_enforce:
+                        next_enforce += interval
+                        self.enforce()
+                    else:
+                        self.save()
+                except Exception as e:
+                    logging.error(f"Storage enforcement failed: {e}")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and save last-served times"""
+        self._stop.set()
+        self.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply the outputs/video retention policy')
+    parser.add_argument('video_dir', nargs='?', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'outputs', 'video'))
+    parser.add_argument('--max-bytes', type=int, default=0)
+    parser.add_argument('--max-age-days', type=float, default=0)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    manager = StorageManager(args.video_dir, args.max_bytes, args.max_age_days)
+    json.dump(manager.enforce(dry_run=args.dry_run), sys.stdout, ensure_ascii=False, indent=2)
+    print()
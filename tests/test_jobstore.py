@@ -0,0 +1,170 @@
+import time
+
+import pytest
+
+import jobstore
+from jobstore import SQLiteJobStore, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+
+# Leases short enough to expire within a test
+SHORT_LEASE = 0.05
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteJobStore(str(tmp_path / 'jobs.sqlite'), max_attempts=3)
+
+
+def expire(lease_seconds=SHORT_LEASE):
+    time.sleep(lease_seconds * 2)
+
+
+def test_lease_claims_oldest_queued_job(store):
+    first = store.submit({'surah': 1})
+    store.submit({'surah': 2})
+
+    job = store.lease('w1', 30)
+
+    assert job['id'] == first
+    assert job['status'] == RUNNING
+    assert job['worker'] == 'w1'
+    assert job['attempts'] == 1
+    assert job['params'] == {'surah': 1}
+
+
+def test_expired_lease_is_leased_again(store):
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', SHORT_LEASE)
+    assert store.lease('w2', 30) is None
+
+    expire()
+    job = store.lease('w2', 30)
+
+    assert job['id'] == job_id
+    assert job['worker'] == 'w2'
+    assert job['attempts'] == 2
+
+
+def test_heartbeat_keeps_lease(store):
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', SHORT_LEASE)
+
+    assert store.heartbeat(job_id, 'w1', 30, 40, 'encoding')
+    expire()
+
+    assert store.lease('w2', 30) is None
+    job = store.get(job_id)
+    assert (job['progress'], job['status_text']) == (40, 'encoding')
+
+
+def test_finish_after_lost_lease_is_refused(store):
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', SHORT_LEASE)
+    expire()
+    store.lease('w2', 30)
+
+    assert not store.heartbeat(job_id, 'w1', 30)
+    assert not store.finish(job_id, 'w1', DONE, '/videos/w1.mp4')
+    job = store.get(job_id)
+    assert job['status'] == RUNNING
+    assert job['worker'] == 'w2'
+
+    assert store.finish(job_id, 'w2', DONE, '/videos/w2.mp4')
+    job = store.get(job_id)
+    assert job['status'] == DONE
+    assert job['output_path'] == '/videos/w2.mp4'
+    assert job['progress'] == 100
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / 'jobs.sqlite'), max_attempts=2)
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', SHORT_LEASE)
+    expire()
+    store.lease('w2', SHORT_LEASE)
+    expire()
+
+    assert store.lease('w3', 30) is None
+    job = store.get(job_id)
+    assert job['status'] == FAILED
+    assert job['attempts'] == 2
+    assert 'lease expired' in job['error']
+    assert job['finished'] is not None
+
+
+def test_cancel_queued_job(store):
+    job_id = store.submit({'surah': 1})
+
+    store.request_cancel(job_id)
+
+    job = store.get(job_id)
+    assert job['status'] == CANCELLED
+    assert job['finished'] is not None
+    assert store.lease('w1', 30) is None
+
+
+def test_cancel_running_job_flags_worker(store):
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', 30)
+
+    store.request_cancel(job_id)
+
+    job = store.get(job_id)
+    assert job['status'] == RUNNING
+    assert job['cancel_requested']
+    assert store.finish(job_id, 'w1', CANCELLED, error='Cancelled by user')
+    assert store.get(job_id)['status'] == CANCELLED
+
+
+def test_cancel_finished_job_is_ignored(store):
+    job_id = store.submit({'surah': 1})
+    store.lease('w1', 30)
+    store.finish(job_id, 'w1', DONE, '/videos/done.mp4')
+
+    store.request_cancel(job_id)
+
+    job = store.get(job_id)
+    assert job['status'] == DONE
+    assert not job['cancel_requested']
+
+
+def test_recover_requeues_or_fails_running_jobs(store):
+    requeued = store.submit({'surah': 1}, worker_id='server-a')
+    failed = store.submit({'surah': 2}, worker_id='server-b')
+
+    assert store.recover('server-a', requeue=True) == [requeued]
+    assert store.recover('server-b') == [failed]
+
+    assert store.get(requeued)['status'] == QUEUED
+    assert store.get(failed)['status'] == FAILED
+    assert store.lease('w1', 30)['id'] == requeued
+
+
+def test_store_in_use_on_another_host_is_refused(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.sqlite')
+    monkeypatch.setattr(jobstore.socket, 'gethostname', lambda: 'host-a')
+    store = SQLiteJobStore(path)
+    store.submit({'surah': 1})
+    store.lease('host-a:1', 30)
+
+    monkeypatch.setattr(jobstore.socket, 'gethostname', lambda: 'host-b')
+    with pytest.raises(ValueError, match='host-a'):
+        SQLiteJobStore(path)
+
+
+def test_idle_store_moved_to_another_host_is_adopted(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.sqlite')
+    monkeypatch.setattr(jobstore.socket, 'gethostname', lambda: 'host-a')
+    job_id = SQLiteJobStore(path).submit({'surah': 1})
+
+    monkeypatch.setattr(jobstore.socket, 'gethostname', lambda: 'host-b')
+    store = SQLiteJobStore(path)
+
+    assert store.lease('host-b:1', 30)['id'] == job_id
+    monkeypatch.setattr(jobstore.socket, 'gethostname', lambda: 'host-a')
+    with pytest.raises(ValueError, match='host-b'):
+        SQLiteJobStore(path)
+
+
+def test_network_share_path_is_refused():
+    with pytest.raises(ValueError, match='network share'):
+        SQLiteJobStore('//fileserver/share/jobs.sqlite')
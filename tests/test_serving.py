@@ -0,0 +1,214 @@
+import os
+
+import pytest
+from flask import Flask, request
+
+from serving import send_video, file_etag, IMMUTABLE_CACHE, REVALIDATE_CACHE
+
+SIZE = 1000
+CONTENT = bytes(i % 251 for i in range(SIZE))
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / 'reel.mp4'
+    path.write_bytes(CONTENT)
+    return str(path)
+
+
+@pytest.fixture
+def client(video):
+    app = Flask(__name__)
+    app.add_url_rule('/video', 'video', lambda: send_video(request, video, immutable=True))
+    app.add_url_rule('/live', 'live', lambda: send_video(request, video))
+    return app.test_client()
+
+
+def etag_of(video):
+    return file_etag(os.stat(video))
+
+
+def test_full_file(client, video):
+    r = client.get('/video')
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+    assert r.headers['Content-Length'] == str(SIZE)
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.headers['ETag'] == etag_of(video)
+    assert r.headers['Content-Type'] == 'video/mp4'
+    assert 'Content-Range' not in r.headers
+
+
+def test_cache_control(client):
+    assert client.get('/video').headers['Cache-Control'] == IMMUTABLE_CACHE
+    assert client.get('/live').headers['Cache-Control'] == REVALIDATE_CACHE
+
+
+def test_bounded_range(client):
+    r = client.get('/video', headers={'Range': 'bytes=100-199'})
+
+    assert r.status_code == 206
+    assert r.data == CONTENT[100:200]
+    assert r.headers['Content-Range'] == f'bytes 100-199/{SIZE}'
+    assert r.headers['Content-Length'] == '100'
+
+
+def test_range_past_end_is_truncated(client):
+    r = client.get('/video', headers={'Range': f'bytes=900-{SIZE + 500}'})
+
+    assert r.status_code == 206
+    assert r.data == CONTENT[900:]
+    assert r.headers['Content-Range'] == f'bytes 900-{SIZE - 1}/{SIZE}'
+
+
+def test_open_range(client):
+    r = client.get('/video', headers={'Range': 'bytes=600-'})
+
+    assert r.status_code == 206
+    assert r.data == CONTENT[600:]
+    assert r.headers['Content-Range'] == f'bytes 600-{SIZE - 1}/{SIZE}'
+
+
+def test_suffix_range(client):
+    r = client.get('/video', headers={'Range': 'bytes=-300'})
+
+    assert r.status_code == 206
+    assert r.data == CONTENT[-300:]
+    assert r.headers['Content-Range'] == f'bytes {SIZE - 300}-{SIZE - 1}/{SIZE}'
+
+
+def test_suffix_range_larger_than_file_sends_whole_file(client):
+    r = client.get('/video', headers={'Range': f'bytes=-{SIZE * 2}'})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+    assert 'Content-Range' not in r.headers
+
+
+def test_open_range_past_end_sends_whole_file(client):
+    for start in (SIZE, SIZE + 1):
+        r = client.get('/video', headers={'Range': f'bytes={start}-'})
+
+        assert r.status_code == 200
+        assert r.data == CONTENT
+        assert 'Content-Range' not in r.headers
+
+
+def test_bounded_range_past_end_is_unsatisfiable(client):
+    r = client.get('/video', headers={'Range': f'bytes={SIZE}-{SIZE + 99}'})
+
+    assert r.status_code == 416
+    assert r.data == b''
+    assert r.headers['Content-Range'] == f'bytes */{SIZE}'
+
+
+def test_multipart_range_sends_whole_file(client):
+    r = client.get('/video', headers={'Range': 'bytes=0-9,100-109'})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+
+
+def test_malformed_range_sends_whole_file(client):
+    r = client.get('/video', headers={'Range': 'pages=1-2'})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+
+
+def test_if_range_matching_etag(client, video):
+    r = client.get('/video', headers={'Range': 'bytes=0-9', 'If-Range': etag_of(video)})
+
+    assert r.status_code == 206
+    assert r.data == CONTENT[:10]
+
+
+def test_stale_if_range_sends_whole_file(client):
+    r = client.get('/video', headers={'Range': 'bytes=0-9', 'If-Range': '"stale-etag"'})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+    assert 'Content-Range' not in r.headers
+
+
+def test_if_range_date_sends_whole_file(client):
+    last_modified = client.get('/video').headers['Last-Modified']
+
+    r = client.get('/video', headers={'Range': 'bytes=0-9', 'If-Range': last_modified})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+
+
+def test_if_none_match_current_etag(client, video):
+    r = client.get('/video', headers={'If-None-Match': etag_of(video)})
+
+    assert r.status_code == 304
+    assert r.data == b''
+    assert r.headers['ETag'] == etag_of(video)
+
+
+def test_if_none_match_in_list_and_weak(client, video):
+    etag = etag_of(video)
+    for header in (f'"other", {etag}', f'W/{etag}', '*'):
+        assert client.get('/video', headers={'If-None-Match': header}).status_code == 304
+
+
+def test_if_none_match_stale_etag(client):
+    r = client.get('/video', headers={'If-None-Match': '"stale-etag"'})
+
+    assert r.status_code == 200
+    assert r.data == CONTENT
+
+
+def test_if_none_match_wins_over_range(client, video):
+    r = client.get('/video', headers={'If-None-Match': etag_of(video), 'Range': 'bytes=0-9'})
+
+    assert r.status_code == 304
+
+
+def test_changed_file_gets_new_etag(client, video):
+    before = etag_of(video)
+    with open(video, 'ab') as f:
+        f.write(b'more')
+
+    r = client.get('/video', headers={'If-None-Match': before})
+
+    assert r.status_code == 200
+    assert r.headers['ETag'] != before
+    assert r.data == CONTENT + b'more'
+
+
+class RecordingWrapper:
+    """wsgi.file_wrapper stand-in that records where the server would start sending"""
+
+    calls = []
+
+    def __init__(self, f, block_size):
+        self.f = f
+        RecordingWrapper.calls.append((f.tell(), block_size))
+
+    def __iter__(self):
+        return iter(lambda: self.f.read(64), b'')
+
+    def close(self):
+        self.f.close()
+
+
+@pytest.mark.parametrize('header, start, length', [
+    ('bytes=100-199', 100, 100),
+    ('bytes=600-', 600, SIZE - 600),
+    ('bytes=-300', SIZE - 300, 300),
+    (None, 0, SIZE),
+])
+def test_ranges_use_file_wrapper(client, header, start, length):
+    RecordingWrapper.calls.clear()
+    headers = {'Range': header} if header else {}
+
+    r = client.get('/video', headers=headers, environ_base={'wsgi.file_wrapper': RecordingWrapper})
+
+    assert RecordingWrapper.calls and RecordingWrapper.calls[0][0] == start
+    assert r.headers['Content-Length'] == str(length)
+    # The server stops after Content-Length bytes
+    assert r.data[:length] == CONTENT[start:start + length]
@@ -0,0 +1,146 @@
+"""
+Quran Reels Generator - Adaptive Upstream Concurrency
+AIMD (additive increase, multiplicative decrease) limit on concurrent requests
+per upstream host, shared by every job in the process. Each fast, successful
+response raises a host's limit by about one per window of requests; throttling
+(HTTP 429/5xx, timeouts, connection errors) or latency well above the host's
+best recent latency cuts it.
+Latency is time to response headers, so a 304 revalidation, a small JSON
+fetch and a full MP3 download of the same host are comparable samples.
+Recent latencies also set the delay before a request whose headers have not
+arrived is hedged to another mirror (see generator.hedged_request).
+"""
+
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+# Successful request latencies kept per host for percentiles and the best latency
+LATENCY_WINDOW = 200
+
+
+class HostLimiter:
+    """Concurrency limit for one upstream host"""
+
+    def __init__(self, host, initial=4, minimum=1, maximum=16,
+                 backoff=0.5, slow_backoff=0.9, slow_factor=3.0):
+        """
+        backoff: limit multiplier on throttling responses or errors
+        slow_backoff: limit multiplier when latency exceeds slow_factor x the best recent
+        """
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.slow_backoff = slow_backoff
+        self.slow_factor = slow_factor
+
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.latency = None        # EWMA of successful request latency (s)
+        self.best_latency = None   # lowest EWMA over the window, the host's unloaded latency
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+        self._recent_ewma = deque(maxlen=LATENCY_WINDOW)
+        self.hedged = 0            # requests raced against another mirror for being slow
+        self.hedge_wins = 0        # races this host answered first
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, cancel=None):
+        """Wait for a free slot; returns the start time to pass to release()"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                if cancel is not None:
+                    cancel.check()
+                self._cond.wait(0.2)
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, ok=True, throttled=False, latency=None):
+        """
+        Record the outcome of a request and adapt the limit.
+        ok: the response was usable; throttled: the host pushed back (429/5xx/timeout)
+        latency: seconds from acquire() to the response headers (default: until now)
+        """
+        now = time.monotonic()
+        elapsed = now - started if latency is None else latency
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            if throttled:
+                self.throttled += 1
+                self._decrease(now, self.backoff)
+            elif ok:
+                self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+                self.recent.append(elapsed)
+                # Best over a sliding window, so one unusually fast response
+                # stops counting once LATENCY_WINDOW newer ones have arrived
+                self._recent_ewma.append(self.latency)
+                self.best_latency = min(self._recent_ewma)
+                if self.latency > self.slow_factor * self.best_latency:
+                    self._decrease(now, self.slow_backoff)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self, now, factor):
+        # Responses to requests sent before the last cut reflect the old limit;
+        # cut at most once per observed round trip
+        window = self.latency or 1.0
+        if now - self._last_decrease >= window:
+            self.limit = max(float(self.minimum), self.limit * factor)
+            self._last_decrease = now
+
+    def latency_percentile(self, q, min_samples=10):
+        """q-quantile of recent successful latencies (s), or None with too few samples"""
+        with self._cond:
+            if len(self.recent) < min_samples:
+                return None
+            ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record_hedge(self, won=False):
+        """Count a hedged race this host took part in as the slow request, or won"""
+        with self._cond:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedged += 1
+
+    def snapshot(self):
+        p95 = self.latency_percentile(0.95)
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+                'p95_ms': round(p95 * 1000) if p95 is not None else None,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(url):
+    """Return the process-wide HostLimiter for a URL's host"""
+    host = urlsplit(url).netloc
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host)
+        return limiter
+
+
+def metrics():
+    """Current limit and counters for every upstream host seen by this process"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.host: limiter.snapshot() for limiter in limiters}
@@ -0,0 +1,422 @@
+"""
+Quran Reels Generator - Warm Render Worker Pool
+Long-lived worker processes that keep the media stack, fonts and background
+list loaded between jobs, so a generation does not pay startup costs.
+Workers are recycled after a configurable number of jobs to contain leaks.
+
+Run as a script, this module starts workers that lease jobs from a shared
+job store instead (see jobstore.py), so capacity scales by starting more
+worker processes. A SQLite store is shared by processes on its own host:
+    python workers.py --store sqlite:///var/lib/quran-reels/jobs.sqlite --processes 4
+
+Render processes on one machine, the server's pool and store workers alike,
+share its cores through a host-wide CoreBudget (see cpu_budget.py): each
+running job's encoder and decoder threads add up to its share of the cores,
+re-read at every pipeline stage as other jobs start and finish.
+"""
+
+import os
+import sys
+import time
+import queue
+import socket
+import logging
+import shutil
+import argparse
+import threading
+import multiprocessing
+
+from cpu_budget import CoreBudget
+
+# Seconds a store lease lasts without a heartbeat, and how often workers renew it
+LEASE_SECONDS = 30
+HEARTBEAT_INTERVAL = 2
+
+
+def worker_audio_dir(app_dir, pid):
+    """Audio scratch folder of the worker process `pid`"""
+    from generator import get_app_dir
+    return os.path.join(app_dir or get_app_dir(), 'outputs', 'audio', str(pid))
+
+
+def _private_audio_dir(generator):
+    """
+    Give a worker process its own audio scratch folder. Each job clears its
+    folder, so workers rendering at the same time cannot share outputs/audio.
+    """
+    generator.audio_dir = worker_audio_dir(generator.app_dir, os.getpid())
+    os.makedirs(generator.audio_dir, exist_ok=True)
+
+
+def _remove_audio_dir(app_dir, pid):
+    shutil.rmtree(worker_audio_dir(app_dir, pid), ignore_errors=True)
+
+
+def _worker_main(tasks, events, cancel_job, app_dir, bundle_dir, log_queue=None, cpu_share=None):
+    """Worker process entry point: preload once, then render jobs until told to exit"""
+    from generator import VideoGenerator, CancelToken, setup_logging
+    import upstream
+
+    # The parent process writes runlog.txt; records are forwarded to it
+    setup_logging(app_dir, forward_to=log_queue)
+
+    generator = VideoGenerator(
+        app_dir=app_dir,
+        bundle_dir=bundle_dir,
+        progress_callback=lambda p, s: events.put(('progress', p, s)),
+        log_callback=lambda m: events.put(('log', m)),
+        stage_callback=lambda name, seconds: events.put(('stage', name, seconds)),
+        cpu_share=cpu_share
+    )
+    _private_audio_dir(generator)
+    elapsed = generator.preload()
+    events.put(('ready', os.getpid(), elapsed))
+
+    # Relay cancel requests from the server into the running generation.
+    # The server cancels a job by writing its number into cancel_job; each job
+    # runs under its own CancelToken, so a cancel that arrives as a job ends
+    # cannot reach the next one, and one that arrives before the job starts
+    # still cancels it.
+    running = [None]   # (job number, CancelToken) of the job being rendered
+
+    def watch_cancel():
+        stopped = None
+        while True:
+            time.sleep(0.1)
+            current = running[0]
+            if current is not None and current is not stopped and cancel_job.value == current[0]:
+                current[1].cancel()
+                stopped = current
+
+    threading.Thread(target=watch_cancel, daemon=True).start()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_number, job = task
+        token = CancelToken()
+        running[0] = (job_number, token)
+        if cpu_share is not None:
+            cpu_share.begin()
+        try:
+            result = generator.generate_video(cancel=token, **job)
+        except Exception as e:
+            result = (False, None, str(e))
+        finally:
+            if cpu_share is not None:
+                cpu_share.end()
+            running[0] = None
+        if generator.profile_path:
+            events.put(('profile', generator.profile_path))
+        events.put(('metrics', upstream.metrics()))
+        events.put(('done', result))
+
+
+class RenderWorker:
+    """One warm worker process and its task/event channels"""
+
+    def __init__(self, ctx, app_dir, bundle_dir, log_queue=None, cpu_share=None):
+        self.tasks = ctx.Queue()
+        self.events = ctx.Queue()
+        self.cancel_job = ctx.Value('q', 0)   # number of the job to cancel
+        self.jobs_sent = 0
+        self.jobs_done = 0
+        self.app_dir = app_dir
+        self.cpu_share = cpu_share
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(self.tasks, self.events, self.cancel_job, app_dir, bundle_dir, log_queue, cpu_share),
+            daemon=True
+        )
+        self.process.start()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def send(self, job):
+        """Queue a job for the worker; returns its number for cancel()"""
+        self.jobs_sent += 1
+        self.tasks.put((self.jobs_sent, job))
+        return self.jobs_sent
+
+    def cancel(self, job_number):
+        self.cancel_job.value = job_number
+
+    def shutdown(self, timeout=5):
+        """Ask the worker to exit, killing it if it does not, and remove its scratch folder"""
+        try:
+            self.tasks.put(None)
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        _remove_audio_dir(self.app_dir, self.pid)
+
+
+class WorkerPool:
+    """
+    Pool of warm render workers.
+    run() blocks the calling thread until a worker has rendered the job,
+    relaying progress and log events back through the given callbacks.
+    """
+
+    def __init__(self, size=1, max_jobs_per_worker=20, app_dir=None, bundle_dir=None, cpu_cores=None):
+        """cpu_cores: cores shared by the jobs on this machine (default cpu_budget.CPU_CORES)"""
+        self.size = max(1, size)
+        self.max_jobs_per_worker = max(1, max_jobs_per_worker)
+        self.app_dir = app_dir
+        self.bundle_dir = bundle_dir
+
+        # spawn keeps workers independent of the server's threads and locks
+        self._ctx = multiprocessing.get_context('spawn')
+        self.cpu = CoreBudget(cpu_cores)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._upstream = {}
+        self._log_queue = None
+
+    def start(self):
+        """Start all workers; they preload in parallel in the background"""
+        with self._lock:
+            if self._started:
+                return
+            if self._log_queue is None:
+                from generator import relay_log_records
+                self._log_queue = self._ctx.Queue()
+                threading.Thread(target=relay_log_records, args=(self._log_queue,), daemon=True).start()
+            for _ in range(self.size):
+                self._idle.put(self._spawn())
+            self._started = True
+        logging.info(f"Render pool started with {self.size} worker(s)")
+
+    def shutdown(self):
+        """Stop all idle workers"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.shutdown()
+        self._started = False
+
+    def upstream_metrics(self):
+        """Adaptive upstream limits last reported by each worker process, keyed by pid"""
+        with self._lock:
+            return dict(self._upstream)
+
+    def cpu_metrics(self):
+        """Cores in the budget and the threads of each job running on this machine, keyed by pid"""
+        return self.cpu.snapshot()
+
+    def _spawn(self):
+        worker = RenderWorker(self._ctx, self.app_dir, self.bundle_dir, self._log_queue, self.cpu.share())
+        logging.info(f"Render worker {worker.pid} started")
+        return worker
+
+    def _release(self, worker):
+        """Return a worker to the pool, recycling it if it is worn out or dead"""
+        if not worker.process.is_alive() or worker.jobs_done >= self.max_jobs_per_worker:
+            logging.info(f"Recycling render worker {worker.pid} after {worker.jobs_done} job(s)")
+            with self._lock:
+                self._upstream.pop(worker.pid, None)
+            # A worker killed mid-job releases its budget lock as it exits
+            worker.shutdown()
+            worker = self._spawn()
+        self._idle.put(worker)
+
+    def run(self, job, progress_callback=None, log_callback=None, cancel=None, stage_callback=None,
+            profile_callback=None):
+        """
+        Render a job (keyword arguments for VideoGenerator.generate_video).
+        cancel: optional CancelToken; cancelling it stops the job in the worker.
+        stage_callback: optional Function(stage, seconds) for pipeline stage timings.
+        profile_callback: optional Function(path) for the stats of a profiled job.
+        Returns: (success: bool, output_path: str or None, error: str or None)
+        """
+        self.start()
+        progress_callback = progress_callback or (lambda p, s: None)
+        log_callback = log_callback or (lambda m: None)
+        stage_callback = stage_callback or (lambda name, seconds: None)
+        profile_callback = profile_callback or (lambda path: None)
+
+        worker = self._idle.get()
+        try:
+            job_number = worker.send(job)
+
+            while True:
+                if cancel is not None and cancel.cancelled:
+                    worker.cancel(job_number)
+                try:
+                    event = worker.events.get(timeout=0.2)
+                except queue.Empty:
+                    if not worker.process.is_alive():
+                        return False, None, "Render worker exited unexpectedly"
+                    continue
+
+                kind = event[0]
+                if kind == 'progress':
+                    progress_callback(event[1], event[2])
+                elif kind == 'log':
+                    log_callback(event[1])
+                elif kind == 'stage':
+                    stage_callback(event[1], event[2])
+                elif kind == 'profile':
+                    profile_callback(event[1])
+                elif kind == 'metrics':
+                    with self._lock:
+                        self._upstream[worker.pid] = event[1]
+                elif kind == 'ready':
+                    logging.info(f"Render worker {event[1]} preloaded in {event[2]:.2f}s")
+                elif kind == 'done':
+                    worker.jobs_done += 1
+                    return event[1]
+        finally:
+            self._release(worker)
+
+
+def run_store_worker(store_spec, app_dir=None, bundle_dir=None, worker_id=None,
+                     lease_seconds=LEASE_SECONDS, poll_interval=1.0, log_queue=None, profile=False,
+                     deadline=None, cpu_share=None):
+    """
+    Lease jobs from a job store and render them until the process is stopped.
+    A heartbeat thread renews the lease and publishes progress while a job
+    runs, and stops the generation if the job is cancelled or the lease lost.
+    log_queue: optional queue to forward log records to a parent process.
+    profile: profile every job, as if each was submitted with profile=True.
+    deadline: default deadline in seconds for jobs submitted without one.
+    cpu_share: optional CoreShare of the budget shared by the render processes
+    on this machine.
+    """
+    from generator import VideoGenerator, setup_logging, get_app_dir
+    from jobstore import open_job_store, DONE, FAILED, CANCELLED
+
+    setup_logging(app_dir or get_app_dir(), forward_to=log_queue)
+
+    store = open_job_store(store_spec)
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    current = {'job_id': None, 'progress': (None, None)}
+
+    def on_progress(percent, status):
+        current['progress'] = (percent, status)
+
+    def on_log(message):
+        if current['job_id']:
+            store.log(current['job_id'], message)
+
+    def on_stage(name, seconds):
+        if current['job_id']:
+            store.record_stage(current['job_id'], name, seconds)
+
+    generator = VideoGenerator(app_dir=app_dir, bundle_dir=bundle_dir,
+                               progress_callback=on_progress, log_callback=on_log,
+                               stage_callback=on_stage, cpu_share=cpu_share)
+    _private_audio_dir(generator)
+    elapsed = generator.preload()
+    logging.info(f"Store worker {worker_id} preloaded in {elapsed:.2f}s")
+
+    def heartbeat(job_id, finished):
+        while not finished.wait(HEARTBEAT_INTERVAL):
+            percent, status = current['progress']
+            if not store.heartbeat(job_id, worker_id, lease_seconds, percent, status):
+                logging.warning(f"Store worker {worker_id} lost the lease on job {job_id}")
+                generator.stop()
+                return
+            if store.get(job_id)['cancel_requested']:
+                generator.stop()
+
+    while True:
+        job = store.lease(worker_id, lease_seconds)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        job_id = job['id']
+        logging.info(f"Store worker {worker_id} leased job {job_id} (attempt {job['attempts']})")
+        current['job_id'] = job_id
+        current['progress'] = (None, None)
+        finished = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(job_id, finished), daemon=True)
+        beat.start()
+        params = dict(job['params'])
+        if params.pop('live', False):
+            params['live_id'] = job_id
+        if profile:
+            params['profile'] = True
+        if deadline:
+            params.setdefault('deadline', deadline)
+        if cpu_share is not None:
+            cpu_share.begin()
+        try:
+            success, output_path, error = generator.generate_video(**params)
+        except Exception as e:
+            success, output_path, error = False, None, str(e)
+        finally:
+            if cpu_share is not None:
+                cpu_share.end()
+            finished.set()
+            beat.join()
+        if generator.profile_path:
+            store.record_profile(job_id, generator.profile_path)
+
+        if success:
+            status = DONE
+        elif generator.cancel_token.cancelled:
+            status = CANCELLED
+        else:
+            status = FAILED
+        percent, text = current['progress']
+        store.heartbeat(job_id, worker_id, lease_seconds, percent, text)
+        store.finish(job_id, worker_id, status, output_path, error)
+        current['job_id'] = None
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from generator import get_app_dir, get_bundle_dir, setup_logging, relay_log_records
+
+    parser = argparse.ArgumentParser(description='Render jobs leased from a shared job store')
+    parser.add_argument('--store', required=True, help='Job store, e.g. sqlite:///shared/jobs.sqlite')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes to start')
+    parser.add_argument('--app-dir', default=get_app_dir())
+    parser.add_argument('--bundle-dir', default=get_bundle_dir())
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS)
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every job and save the stats next to its video')
+    parser.add_argument('--deadline', type=float,
+                        help='Deadline in seconds for jobs submitted without one')
+    parser.add_argument('--cpu-cores', type=int,
+                        help='Cores shared by the render processes on this machine (default: all)')
+    args = parser.parse_args()
+    setup_logging(args.app_dir)
+
+    ctx = multiprocessing.get_context('spawn')
+    log_queue = ctx.Queue()
+    threading.Thread(target=relay_log_records, args=(log_queue,), daemon=True).start()
+    count = max(1, args.processes)
+    budget = CoreBudget(args.cpu_cores)
+    processes = [
+        ctx.Process(target=run_store_worker, daemon=True,
+                    args=(args.store, args.app_dir, args.bundle_dir),
+                    kwargs={'lease_seconds': args.lease_seconds, 'log_queue': log_queue,
+                            'profile': args.profile, 'deadline': args.deadline,
+                            'cpu_share': budget.share()})
+        for _ in range(count)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+    finally:
+        for process in processes:
+            _remove_audio_dir(args.app_dir, process.pid)